@@ -1,10 +1,16 @@
 import os
 import re
+import sys
 import json
 import csv
 from pathlib import Path
-from bs4 import BeautifulSoup
-import bs4.element
+
+# moteur de recherche des alias, extraction HTML et cache partagés avec model/cli/ner_create.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "model" / "cli"))
+from alias_matcher import AliasMatcher
+from dodis_ids import ID_PATTERNS
+from extraction_cache import ExtractionCache
+from html_extract import CACHE_NAMESPACE, extract_blocks
 
 # === Répertoires ===
 INPUT_DIR = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/raw_data")
@@ -13,6 +19,7 @@ OUTPUT_WARNINGS_FILE = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_
 OUTPUT_ALIAS_JSON = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/data_pre_analysis/entity_aliases.json")
 OUTPUT_ALIAS_DISTRIBUTION_JSON = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/data_pre_analysis/entity_aliases_distribution.json")
 OUTPUT_SINGLETON_CSV = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/data_pre_analysis/entity_singletons.csv")
+CACHE_DIR = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/data_pre_analysis/.extraction_cache")
 
 # === Compteurs et collecteurs ===
 entity_counter = {"PER": 0, "LOC": 0, "ORG": 0}
@@ -22,13 +29,6 @@ ignored_entities = []
 alias_to_uris = {}
 uri_mention_counts = {}
 
-# === Regex pour validation des liens ===
-ID_PATTERNS = {
-    "PER": re.compile(r"^https?://dodis\.ch/P\d+$"),
-    "LOC": re.compile(r"^https?://dodis\.ch/G\d+$"),
-    "ORG": re.compile(r"^https?://dodis\.ch/R\d+$"),
-}
-
 def trans_class_name(class_name: str) -> str:
     return {
         "tei-persName": "PER",
@@ -42,80 +42,51 @@ class Entity:
         self.content = ""
         self.class_names = ["tei-persName", "tei-placeName", "tei-orgName"]
 
-    def find(self, content: str, tag: bs4.element.Tag):
+    def find(self, content: str, anchors: list):
         self.content = content
-        matches = tag.find_all('a')
         raw = []
-        for m in matches:
-            if m.get("class") and m.get("class")[0] in self.class_names:
-                label = trans_class_name(m.get("class")[0])
-                text = m.get_text().strip()
-                href = m.get("href")
+        for text, classes, href in anchors:
+            if classes and classes[0] in self.class_names:
+                label = trans_class_name(classes[0])
                 if not href:
                     ignored_entities.append(f"[{file.name}] Entité sans href : {text}")
                     continue
                 href = re.sub(r"^http://", "https://", href.strip())
                 raw.append((text, label, href))
-        #raw = list(set(raw))  # suppression des doublons
-        raw = sorted(set(raw))  # suppression des doublons
-
-        for m, label, href in raw:
-            pattern = r'(%s)' % re.escape(m)
-            indexes = re.finditer(pattern, content, flags=re.IGNORECASE)
-            for match in indexes:
-                found = False
-                for ent in self.entities:
-                    if ent[0] <= match.start() and ent[1] >= match.end():
-                        found = True
-                        break
-                if not found:
-                    self.entities.append((match.start(), match.end(), label, href))
-                    # Enregistrement des alias
-                    if href in entity_aliases:
-                        entity_aliases[href]["aliases"].add(m)
-                    else:
-                        entity_aliases[href] = {
-                            "label": label,
-                            "aliases": {m}
-                        }
-                    # Mapping alias → URIs
-                    if m in alias_to_uris:
-                        alias_to_uris[m].add(href)
-                    else:
-                        alias_to_uris[m] = {href}
-                    # Comptage des mentions par URI
-                    if href in uri_mention_counts:
-                        uri_mention_counts[href] += 1
-                    else:
-                        uri_mention_counts[href] = 1
+        # recherche de tous les alias en une passe, du plus long au plus court
+        for start, end, m, (label, href) in AliasMatcher((m, (label, href)) for m, label, href in raw).find(content):
+            self.entities.append((start, end, label, href))
+            # Enregistrement des alias
+            if href in entity_aliases:
+                entity_aliases[href]["aliases"].add(m)
+            else:
+                entity_aliases[href] = {
+                    "label": label,
+                    "aliases": {m}
+                }
+            # Mapping alias → URIs
+            if m in alias_to_uris:
+                alias_to_uris[m].add(href)
+            else:
+                alias_to_uris[m] = {href}
+            # Comptage des mentions par URI
+            if href in uri_mention_counts:
+                uri_mention_counts[href] += 1
+            else:
+                uri_mention_counts[href] = 1
 
     def get_entities(self):
         return [t for t in self.entities if t]
 
 # === Traitement de chaque fichier HTML ===
 #for file in INPUT_DIR.glob("*.html"):
+cache = ExtractionCache(CACHE_DIR)
 for file in sorted(INPUT_DIR.glob("*.html")):
-    with open(file, "r", encoding="utf-8") as f:
-        text = f.read()
-
-    soup = BeautifulSoup(text, "html.parser")
-    paragraphs = []
-
-    title = soup.find('div', {"class": 'tei-title-main'})
-    if title:
-        paragraphs.append(title)
-    subtitle = soup.find('h1', {"class": 'tei-title-sub'})
-    if subtitle:
-        paragraphs.append(subtitle)
-    paragraphs.extend(soup.find_all('p'))
-
-    for p in paragraphs:
-        if p is None:
-            continue
-        [note.extract() for note in p.select('.tei-note, .tei-note2, .tei-note3, .tei-note4')]
-        content = p.get_text().strip()
+    # blocs (titre, sous-titre, paragraphes sans notes) relus depuis le cache si le fichier n'a pas changé
+    for block in cache.get_or_compute(file, extract_blocks, CACHE_NAMESPACE):
+        content = block["text"]
         entity = Entity()
-        entity.find(content, p)
+        entity.find(content, block["anchors"])
         for start, end, label, href in entity.get_entities():
             entity_counter[label] += 1
             if ID_PATTERNS.get(label) and ID_PATTERNS[label].match(href):
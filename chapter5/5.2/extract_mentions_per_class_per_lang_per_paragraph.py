@@ -1,11 +1,17 @@
 import os
 import re
+import sys
 import csv
 from pathlib import Path
-from bs4 import BeautifulSoup
 from langdetect import detect, LangDetectException
 import nltk
 
+# extraction HTML et cache partagés avec model/cli/ner_create.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "model" / "cli"))
+from dodis_ids import ID_PATTERNS
+from extraction_cache import ExtractionCache
+from html_extract import CACHE_NAMESPACE, extract_blocks
+
 from collections import defaultdict
 
 nltk.download('punkt')
@@ -14,16 +20,12 @@ nltk.download('punkt')
 INPUT_DIR = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/raw_data")
 OUTPUT_CSV = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/data_pre_analysis/entity_count_by_lang_exhaustive.csv")
 EXPORT_LANG_DIR = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/data_pre_analysis/lang_exports")
+CACHE_DIR = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/data_pre_analysis/.extraction_cache")
 
 # === Config ===
 TARGET_LANGS = {'fr': 'français', 'de': 'allemand', 'en': 'anglais', 'it': 'italien'}
 ENTITY_CLASSES = ["tei-persName", "tei-placeName", "tei-orgName"]
 ENTITY_LABELS = {"tei-persName": "PER", "tei-placeName": "LOC", "tei-orgName": "ORG"}
-ID_PATTERNS = {
-    "PER": re.compile(r"^https?://dodis\.ch/P\d+$"),
-    "LOC": re.compile(r"^https?://dodis\.ch/G\d+$"),
-    "ORG": re.compile(r"^https?://dodis\.ch/R\d+$"),
-}
 FALLBACK_LANG = "inconnue"
 
 # === Stockage des résultats pour le CSV
@@ -38,31 +40,18 @@ total_paragraphs = 0
 lang_sentences = defaultdict(list)
 EXPORT_LANG_DIR.mkdir(exist_ok=True)
 
+cache = ExtractionCache(CACHE_DIR)
 for file in INPUT_DIR.glob("*.html"):
+    # Blocs à traiter = titres et paragraphes (sans notes), relus depuis le cache si le fichier n'a pas changé
     try:
-        with open(file, "r", encoding="utf-8") as f:
-            text = f.read()
+        blocks = cache.get_or_compute(file, extract_blocks, CACHE_NAMESPACE)
     except Exception as e:
         print(f"[ERREUR] Lecture du fichier {file.name}: {e}")
         skipped_files.append((file.name, str(e)))
         continue
 
-    soup = BeautifulSoup(text, "html.parser")
-
-    # Blocs à traiter = titres et paragraphes
-    blocks = []
-    title = soup.find('div', {"class": 'tei-title-main'})
-    if title: blocks.append(title)
-    subtitle = soup.find('h1', {"class": 'tei-title-sub'})
-    if subtitle: blocks.append(subtitle)
-    ps = soup.find_all('p')
-    blocks.extend(ps)
-
-    for p in blocks:
-        if p is None:
-            continue
-        [note.extract() for note in p.select('.tei-note, .tei-note2, .tei-note3, .tei-note4')]
-        content = p.get_text().strip()
+    for block in blocks:
+        content = block["text"]
         total_paragraphs += 1
         if not content:
             continue
@@ -90,13 +79,11 @@ for file in INPUT_DIR.glob("*.html"):
 
         # === Extraction des entités et comptage ===
         found_entities = set()
-        for a in p.find_all('a'):
+        for alias, classes, href in block["anchors"]:
             try:
-                if a.get("class") and a.get("class")[0] in ENTITY_CLASSES:
-                    class_name = a.get("class")[0]
+                if classes and classes[0] in ENTITY_CLASSES:
+                    class_name = classes[0]
                     label = ENTITY_LABELS[class_name]
-                    href = a.get("href")
-                    alias = a.get_text().strip()
                     if href and ID_PATTERNS[label].match(href.strip()):
                         found_entities.add((alias, label))
                     else:
@@ -1,24 +1,23 @@
 import os
+import sys
 import json
-import re
 from pathlib import Path
-from bs4 import BeautifulSoup
 from collections import defaultdict
 import csv
 import matplotlib.pyplot as plt
 
+# extraction HTML et cache partagés avec model/cli/ner_create.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "model" / "cli"))
+from dodis_ids import ID_PATTERNS
+from extraction_cache import ExtractionCache
+from html_extract import CACHE_NAMESPACE, extract_blocks
+
 # === CONFIGURATION DES RÉPERTOIRES ===
 JSON_DIR = Path('/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/metadata/json-extracted-structured')
 HTML_DIR = Path('/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/raw_data')
 OUTPUT_DIR = Path("outputs_cross_entities_HTML_META")
 OUTPUT_DIR.mkdir(exist_ok=True)
-
-# === REGEX POUR HTML (URL Dodis attendues) ===
-ID_PATTERNS = {
-    "PER": re.compile(r"^https?://dodis\.ch/P\d+$"),
-    "LOC": re.compile(r"^https?://dodis\.ch/G\d+$"),
-    "ORG": re.compile(r"^https?://dodis\.ch/R\d+$"),
-}
+CACHE_DIR = OUTPUT_DIR / ".extraction_cache"
 
 # === MAPPINGS DE CLASSES ===
 def trans_class_name(class_name: str) -> str:
@@ -62,23 +61,11 @@ for file in JSON_DIR.glob("*.json"):
 
 # === EXTRACTION HTML (identifiants TEI déjà normalisés) ===
 html_entities = defaultdict(set)
+cache = ExtractionCache(CACHE_DIR)
 for file in HTML_DIR.glob("*.html"):
-    with open(file, "r", encoding="utf-8") as f:
-        soup = BeautifulSoup(f.read(), "html.parser")
-
-    elements = []
-    title = soup.find('div', class_='tei-title-main')
-    if title: elements.append(title)
-    subtitle = soup.find('h1', class_='tei-title-sub')
-    if subtitle: elements.append(subtitle)
-    elements.extend(soup.find_all('p'))
-
-    for el in elements:
-        if el is None: continue
-        [note.extract() for note in el.select('.tei-note4, .tei-note2, .tei-note3, .tei-note')]
-        for a in el.find_all('a'):
-            href = a.get("href")
-            classes = a.get("class", [])
+    # blocs (titre, sous-titre, paragraphes sans notes) relus depuis le cache si le fichier n'a pas changé
+    for block in cache.get_or_compute(file, extract_blocks, CACHE_NAMESPACE):
+        for _text, classes, href in block["anchors"]:
             for cls in classes:
                 label = trans_class_name(cls)
                 if label in ID_PATTERNS and href and ID_PATTERNS[label].match(href):
@@ -4,7 +4,11 @@ import re
 import sys
 from collections import defaultdict
 from pathlib import Path
-from typing import Any, List, Tuple, Dict, Set
+from typing import Any, Iterable, Iterator, Tuple, Dict, Set
+
+# lecture en continu des données d'entraînement (model/cli/traindata_io.py)
+sys.path.insert(0, str(Path(__file__).resolve().parents[3] / "model" / "cli"))
+from traindata_io import iter_train_data
 
 Annotation = Tuple[int, int, str, str]  # (start, end, label, uri)
 
@@ -15,17 +19,17 @@ def clean_alias(alias: str) -> str:
     alias = _whitespace_re.sub(" ", alias)
     return alias.strip()
 
-def load_json(path: Path) -> List[Any]:
-    try:
-        with path.open(encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"Erreur lors du chargement de {path} : {e}")
+def load_json(path: Path) -> Iterator[Any]:
+    if not path.exists():
+        print(f"Erreur lors du chargement de {path} : fichier introuvable")
         sys.exit(1)
+    return iter_train_data(path)
 
-def extract_aliases(data: List[Any]) -> Dict[str, Set[str]]:
+def extract_aliases(data: Iterable[Any]) -> Tuple[Dict[str, Set[str]], int]:
     uri_aliases: Dict[str, Set[str]] = defaultdict(set)
+    n_items = 0
     for item in data:
+        n_items += 1
         if not isinstance(item, list) or len(item) != 2:
             continue
         text, annotations = item
@@ -42,7 +46,7 @@ def extract_aliases(data: List[Any]) -> Dict[str, Set[str]]:
                         key = alias_clean.casefold()
                         if key not in {a.casefold() for a in uri_aliases[uri]}:
                             uri_aliases[uri].add(alias_clean)
-    return uri_aliases
+    return uri_aliases, n_items
 
 def save_json(obj: Any, path: Path, description: str) -> None:
     with path.open("w", encoding="utf-8") as f:
@@ -50,13 +54,12 @@ def save_json(obj: Any, path: Path, description: str) -> None:
     print(f"✅ {description} sauvegardé : {path}")
 
 def main() -> None:
-    input_path = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/basic_prepared_ner/ner_traindata.json")
+    input_path = Path("/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/basic_prepared_ner/ner_traindata.jsonl")
     output_path = Path("/Users/xbaume/Documents/MA_Xavier/extract_from_beta_dodis/trying_LOD/recensement_prepared_traindata.json")
 
     data = load_json(input_path)
-    print(f"{len(data)} passages chargés")
-
-    uri_aliases = extract_aliases(data)
+    uri_aliases, n_items = extract_aliases(data)
+    print(f"{n_items} passages chargés")
 
     results = [{"uri": uri, "aliases": sorted(aliases)} for uri, aliases in sorted(uri_aliases.items())]
     save_json(results, output_path, "Export")
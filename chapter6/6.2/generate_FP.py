@@ -1,8 +1,13 @@
 import spacy
 import csv
-import json
 import re
+import sys
 from collections import defaultdict, Counter
+from pathlib import Path
+
+# lecture en continu des données d'entraînement (model/cli/traindata_io.py)
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "model" / "cli"))
+from traindata_io import iter_train_data
 
 def normalize_entity(text):
     # Normalisation simple : minuscule, suppression pluriel/suffixes de type -es/-e, stripping
@@ -20,14 +25,13 @@ PATH_NEL = "/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/el-results/mo
 nlp = spacy.load(PATH_NER)
 nlp.add_pipe("entity_linker", source=spacy.load(PATH_NEL), last=True)
 
-INPUT_JSON = "/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/basic_prepared_ner/ner_traindata.json"
+INPUT_JSON = "/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/basic_prepared_ner/ner_traindata.jsonl"
 CSV_EXPORT = "/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/results_ner_nel/test-2/results_org_entities_goldonly_enriched.csv"
 CSV_TOP_FP = "/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/results_ner_nel/test-2/top_fp_normalized.csv"
 CSV_MULTI_FP_PHRASE = "/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/results_ner_nel/test-2/phrases_multi_fp.csv"
 CSV_HOMONYMY = "/Users/xbaume/Documents/MA_Xavier/NER/fancy-ml-ner_xav/results_ner_nel/test-2/homonymes_kb_id.csv"
 
-with open(INPUT_JSON, 'r', encoding='utf-8') as f:
-    data = json.load(f)
+data = iter_train_data(INPUT_JSON)
 
 rows = []
 entity_contexts = defaultdict(list)         # Pour chaque entité, ses contextes
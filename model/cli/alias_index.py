@@ -0,0 +1,235 @@
+"""
+Index compact des alias de la KB (marisa-trie) et générateurs de candidats pour l'entity_linker.
+
+Les alias sont normalisés comme clean_alias de chapter5/5.4/trying_LOD/extract_alias_from_json.py
+(NFKC, espaces regroupés, strip) puis casefold : « Bundesrat », « BUNDESRAT » et « Bundes­rat » (NBSP, etc.)
+partagent une clé. Chaque clé porte les enregistrements (ligne d'entité, prior) de ses candidats :
+les comptes des variantes sont additionnés et les priors recalculés comme dans build_kb.alias_priors.
+Les clés sont partitionnées par type d'entité (préfixe P/G/R de l'identifiant Dodis, voir dodis_ids.py) :
+« PER\x1fwashington » ne porte que les personnes, avec des priors calculés dans la partition. La partition « * »
+ne porte que les alias dont les candidats sont de plusieurs types, avec les priors calculés sur tous les candidats ;
+pour les autres, la partition de leur unique type a les mêmes priors. Une mention étiquetée PER/LOC/ORG n'interroge
+que sa partition (repli sur tous les types si elle est vide) ; une mention d'un autre label interroge « * »,
+puis chaque partition de type jusqu'à trouver la clé.
+    <kb>/alias_index/aliases.marisa   RecordTrie clé normalisée -> [(ligne, prior), ...]
+    <kb>/alias_index/entities.json    ligne -> kb_id
+    <kb>/alias_index/freqs.npy        float32, fréquence de chaque entité
+    <kb>/alias_index/cfg.json
+
+Dans config.cfg (avec --code cli/alias_index.py), recherche groupée de toutes les mentions d'un lot de docs :
+[components.entity_linker]
+candidates_batch_size = 64
+[components.entity_linker.get_candidates]
+@misc = "dodis.TrieCandidates.v1"
+index_path = "../kb/alias_index"
+[components.entity_linker.get_candidates_batch]
+@misc = "dodis.TrieCandidatesBatch.v1"
+index_path = "../kb/alias_index"
+typed = true
+Avec candidates_batch_size = 1 (valeur actuelle), spaCy appelle get_candidates mention par mention.
+
+Usage:
+python cli/alias_index.py --kb ./kb_exported
+"""
+import json
+import re
+import unicodedata
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+import marisa_trie
+import numpy as np
+import spacy
+from spacy.kb import Candidate, KnowledgeBase
+from spacy.tokens import Span
+
+from dodis_ids import UNTYPED, entity_type
+
+RECORD_FORMAT = "<If"
+ALL_TYPES = "*"
+TYPE_SEP = "\x1f"
+_whitespace_re = re.compile(r"\s+")
+
+
+def normalize_alias(alias: str) -> str:
+    alias = unicodedata.normalize("NFKC", alias)
+    alias = _whitespace_re.sub(" ", alias)
+    return alias.strip().casefold()
+
+
+def merged_priors(counts: Dict[str, int]) -> List[Tuple[str, float]]:
+    # mêmes priors lissés que build_kb.alias_priors
+    total = sum(counts.values())
+    return [(eid, (c + 1) / (total + len(counts))) for eid, c in counts.items()]
+
+
+class AliasIndex:
+
+    def __init__(self, trie: marisa_trie.RecordTrie, entities: List[str], freqs: np.ndarray, cfg: dict = None):
+        self.trie = trie
+        self.entities = entities
+        self.freqs = freqs
+        self.cfg = cfg or {}
+        # index antérieur au partitionnement : clés sans préfixe de type
+        self.types = set(self.cfg.get("types", []))
+
+    @classmethod
+    def from_counts(cls, aliases: Dict[str, Dict[str, int]], entity_freqs: Dict[str, float]) -> "AliasIndex":
+        """
+        Index à partir des comptes bruts alias -> entité -> mentions (kb_state.json de build_kb.py)
+        """
+        entities = list(entity_freqs)
+        row_of = {eid: i for i, eid in enumerate(entities)}
+        type_of = {eid: entity_type(eid) or UNTYPED for eid in entities}
+        by_key = defaultdict(lambda: defaultdict(int))
+        for alias, cand in aliases.items():
+            key = normalize_alias(alias)
+            if not key:
+                continue
+            for eid, count in cand.items():
+                if eid in row_of:
+                    by_key[key][eid] += count
+        merged = {}
+        for key, counts in by_key.items():
+            types = defaultdict(dict)
+            for eid, count in counts.items():
+                types[type_of[eid]][eid] = count
+            if len(types) > 1:
+                merged[ALL_TYPES + TYPE_SEP + key] = counts
+            for etype, type_counts in types.items():
+                merged[etype + TYPE_SEP + key] = type_counts
+        records = [(key, (row_of[eid], prior)) for key, counts in merged.items() for eid, prior in merged_priors(counts)]
+        freqs = np.array([entity_freqs[eid] for eid in entities], dtype=np.float32)
+        partitions = defaultdict(lambda: {"entities": 0, "keys": 0})
+        for etype in type_of.values():
+            partitions[etype]["entities"] += 1
+        # « * » : alias de plusieurs types et entités qu'ils désignent
+        partitions[ALL_TYPES]["entities"] = len({eid for key, counts in merged.items()
+                                                 if key.startswith(ALL_TYPES + TYPE_SEP) for eid in counts})
+        for key in merged:
+            partitions[key.split(TYPE_SEP, 1)[0]]["keys"] += 1
+        cfg = {"n_aliases": len(aliases), "n_keys": len(by_key), "n_records": len(records),
+               "types": sorted(t for t in partitions if t != ALL_TYPES), "partitions": dict(partitions)}
+        return cls(marisa_trie.RecordTrie(RECORD_FORMAT, records), entities, freqs, cfg)
+
+    def untyped(self, key: str) -> List[Tuple[int, float]]:
+        """
+        Candidats de tous les types d'une clé normalisée : partition « * », sinon la partition de l'unique type
+        """
+        for prefix in (ALL_TYPES, *sorted(self.types)):
+            recs = self.trie.get(prefix + TYPE_SEP + key)
+            if recs:
+                return recs
+        return []
+
+    def find(self, key: str, label: str = None) -> List[Tuple[int, float]]:
+        if not self.types:
+            return self.trie.get(key) or []
+        if label in self.types:
+            recs = self.trie.get(label + TYPE_SEP + key)
+            if recs:
+                return recs
+        return self.untyped(key)
+
+    def lookup(self, alias: str, label: str = None) -> List[Tuple[int, float]]:
+        """
+        [(ligne d'entité, prior), ...] de la forme normalisée de l'alias, dans la partition du label s'il en a une
+        """
+        return self.lookup_batch([alias], [label])[0]
+
+    def lookup_batch(self, aliases: Iterable[str], labels: Iterable[str] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Une seule recherche par (clé, label) distincts ; partition vide -> repli sur tous les types
+        """
+        aliases = list(aliases)
+        labels = list(labels) if labels is not None else [None] * len(aliases)
+        queries = [(normalize_alias(a), label if label in self.types else None) for a, label in zip(aliases, labels)]
+        found = {query: self.find(*query) for query in set(queries)}
+        return [found[query] for query in queries]
+
+    def to_disk(self, path: Union[str, Path]):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        self.trie.save(str(path / "aliases.marisa"))
+        (path / "entities.json").write_text(json.dumps(self.entities, ensure_ascii=False), "utf-8")
+        np.save(path / "freqs.npy", self.freqs)
+        (path / "cfg.json").write_text(json.dumps(self.cfg, indent=2), "utf-8")
+
+    @classmethod
+    def from_disk(cls, path: Union[str, Path]) -> "AliasIndex":
+        path = Path(path)
+        trie = marisa_trie.RecordTrie(RECORD_FORMAT).mmap(str(path / "aliases.marisa"))
+        return cls(trie, json.loads((path / "entities.json").read_text("utf-8")),
+                   np.load(path / "freqs.npy", mmap_mode="r"), json.loads((path / "cfg.json").read_text("utf-8")))
+
+
+class TrieCandidates:
+    """
+    Candidats de l'index d'alias ; les vecteurs sont demandés à la KB en un appel par lot.
+    typed : restreindre les candidats au type de l'étiquette NER de la mention
+    """
+
+    def __init__(self, index_path: Union[str, Path], typed: bool = True):
+        self.index = AliasIndex.from_disk(index_path)
+        self.typed = typed
+
+    def labels(self, mentions: List[Span]) -> List[str]:
+        return [m.label_ if self.typed else None for m in mentions]
+
+    def make_candidates(self, kb: KnowledgeBase, mentions: List[Span],
+                        records: List[List[Tuple[int, float]]]) -> List[List[Candidate]]:
+        rows = sorted({row for recs in records for row, _ in recs})
+        entities = [self.index.entities[row] for row in rows]
+        vectors = dict(zip(rows, kb.get_vectors(entities))) if rows else {}
+        strings = kb.vocab.strings
+        out = []
+        for mention, recs in zip(mentions, records):
+            alias_hash = strings.add(mention.text)
+            out.append([
+                Candidate(kb=kb, entity_hash=strings.add(self.index.entities[row]),
+                          entity_freq=float(self.index.freqs[row]), entity_vector=vectors[row],
+                          alias_hash=alias_hash, prior_prob=prior)
+                for row, prior in recs
+            ])
+        return out
+
+    def __call__(self, kb: KnowledgeBase, mention: Span) -> List[Candidate]:
+        return self.batch(kb, [mention])[0]
+
+    def batch(self, kb: KnowledgeBase, mentions: Iterable[Span]) -> List[List[Candidate]]:
+        mentions = list(mentions)
+        return self.make_candidates(kb, mentions, self.index.lookup_batch([m.text for m in mentions],
+                                                                           self.labels(mentions)))
+
+
+@spacy.registry.misc("dodis.TrieCandidates.v1")
+def create_trie_candidates(index_path: Path, typed: bool = True) -> Callable[[KnowledgeBase, Span], List[Candidate]]:
+    return TrieCandidates(index_path, typed)
+
+
+@spacy.registry.misc("dodis.TrieCandidatesBatch.v1")
+def create_trie_candidates_batch(
+    index_path: Path, typed: bool = True
+) -> Callable[[KnowledgeBase, Iterable[Span]], List[List[Candidate]]]:
+    return TrieCandidates(index_path, typed).batch
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Construit l'index marisa-trie des alias normalisés d'une KB")
+    parser.add_argument("--kb", required=True, help="Dossier de sortie de build_kb.py (kb_state.json)")
+    parser.add_argument("--output", default=None, help="Par défaut : <kb>/alias_index")
+    args = parser.parse_args()
+
+    kb_dir = Path(args.kb)
+    state = json.loads((kb_dir / "kb_state.json").read_text("utf-8"))
+    index = AliasIndex.from_counts(state["aliases"], {eid: v[0] for eid, v in state["entities"].items()})
+    output = Path(args.output) if args.output else kb_dir / "alias_index"
+    index.to_disk(output)
+    size = (output / "aliases.marisa").stat().st_size
+    print(f"{index.cfg['n_aliases']} alias → {index.cfg['n_keys']} clés normalisées, "
+          f"{index.cfg['n_records']} enregistrements, trie de {size / 1024:.1f} Ko → {output}")
+    for etype in index.cfg["types"] + [ALL_TYPES]:
+        part = index.cfg["partitions"].get(etype, {"entities": 0, "keys": 0})
+        print(f"  {etype:<5} {part['entities']:>8} entités {part['keys']:>8} clés")
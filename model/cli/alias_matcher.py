@@ -0,0 +1,113 @@
+"""
+Recherche en une passe de toutes les formes (alias) des ancres TEI d'un paragraphe.
+
+Partagé par model/cli/ner_create.py et chapter4/4.3/extract_mentions_from_html.py.
+"""
+import re
+from typing import Any, Hashable, Iterable, List, Tuple
+
+# (start, end, alias, payload)
+Match = Tuple[int, int, str, Any]
+
+
+class IntervalIndex:
+    """
+    Index des intervalles retenus (arbre de Fenwick sur les positions de début, max des fins)
+    Permet de tester en O(log n) si un intervalle est déjà couvert par un intervalle retenu.
+    """
+
+    def __init__(self, size: int):
+        self.size = size + 1
+        self.tree = [-1] * (self.size + 1)
+
+    def add(self, start: int, end: int):
+        i = start + 1
+        while i <= self.size:
+            if self.tree[i] < end:
+                self.tree[i] = end
+            i += i & -i
+
+    def max_end(self, start: int) -> int:
+        """
+        Plus grande fin parmi les intervalles commençant à une position <= start
+        """
+        i = min(start + 1, self.size)
+        best = -1
+        while i > 0:
+            if self.tree[i] > best:
+                best = self.tree[i]
+            i -= i & -i
+        return best
+
+    def covers(self, start: int, end: int) -> bool:
+        return self.max_end(start) >= end
+
+
+class AliasMatcher:
+    """
+    Automate de recherche multi-alias : une seule regex d'alternatives triées du plus long au plus court,
+    insensible à la casse, placée dans un lookahead pour obtenir aussi les occurrences qui se chevauchent.
+    """
+
+    def __init__(self, aliases: Iterable[Tuple[str, Hashable]]):
+        # suppression des doublons et tri par longueur du plus grand au plus petit (ordre déterministe)
+        unique = sorted(set((alias, payload) for alias, payload in aliases if alias),
+                        key=lambda x: (-len(x[0]), x[0], repr(x[1])))
+        self.aliases = []
+        seen = set()
+        for alias, payload in unique:
+            # même forme avec plusieurs étiquettes : la première l'emporte (span identique ensuite couvert)
+            if alias in seen:
+                continue
+            seen.add(alias)
+            self.aliases.append((alias, payload))
+        # alias regroupés par (longueur, forme en minuscules) pour retrouver ceux qui débutent à la même position
+        self.by_key = {}
+        for rank, (alias, _) in enumerate(self.aliases):
+            self.by_key.setdefault((len(alias), alias.lower()), []).append(rank)
+        self.lengths = sorted({len(alias) for alias, _ in self.aliases}, reverse=True)
+        self.regex = None
+        if self.aliases:
+            alternatives = "|".join("(%s)" % re.escape(alias) for alias, _ in self.aliases)
+            self.regex = re.compile(r"(?=(?:%s))" % alternatives, flags=re.IGNORECASE)
+
+    def candidates(self, content: str) -> List[Tuple[int, int, int]]:
+        """
+        Toutes les occurrences (start, end, rang de l'alias).
+        Pour un même alias, les occurrences qui se chevauchent sont écartées comme avec re.finditer.
+        """
+        if self.regex is None:
+            return []
+        found = []
+        last_end = {}
+        for match in self.regex.finditer(content):
+            # la regex donne l'alias le plus long à cette position, les plus courts en sont des préfixes
+            longest = match.lastindex - 1
+            start, end = match.span(match.lastindex)
+            text = content[start:end].lower()
+            ranks = [longest]
+            for length in self.lengths:
+                if length <= end - start:
+                    ranks.extend(r for r in self.by_key.get((length, text[:length]), ()) if r != longest)
+            for rank in ranks:
+                if start < last_end.get(rank, 0):
+                    continue
+                last_end[rank] = start + len(self.aliases[rank][0])
+                found.append((start, last_end[rank], rank))
+        return found
+
+    def find(self, content: str) -> List[Match]:
+        """
+        Occurrences retenues, dans l'ordre de traitement (alias le plus long d'abord) :
+        une occurrence entièrement couverte par une occurrence déjà retenue est ignorée.
+        """
+        found = sorted(self.candidates(content), key=lambda c: (c[2], c[0]))
+        index = IntervalIndex(len(content))
+        result = []
+        for start, end, rank in found:
+            if index.covers(start, end):
+                continue
+            index.add(start, end)
+            alias, payload = self.aliases[rank]
+            result.append((start, end, alias, payload))
+        return result
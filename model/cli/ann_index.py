@@ -0,0 +1,313 @@
+"""
+Recherche approchée des plus proches voisins parmi les vecteurs d'entités de la KB (index IVF en NumPy).
+
+Les vecteurs (normalisés, similarité cosinus) sont répartis par k-means sphérique en n_lists listes ;
+une requête ne parcourt que les `nprobe` listes dont le centroïde est le plus proche.
+    <kb>/ann_index/cfg.json        dimension, nombre de listes, encodeur et contextes de la KB (meta.json)
+    <kb>/ann_index/entities.json   identifiants des entités (ligne -> kb_id)
+    <kb>/ann_index/centroids.npy   float32 [n_lists, dim]
+    <kb>/ann_index/offsets.npy     int64 [n_lists + 1]
+    <kb>/ann_index/rows.npy        int32, lignes des entités rangées par liste
+    <kb>/ann_index/vectors.npy     float32, vecteurs normalisés dans le même ordre que rows
+
+Sert de générateur de candidats de secours à l'entity_linker : une mention sans alias connu reçoit
+les k entités dont le vecteur est le plus proche de l'encodage de son contexte, construit comme dans build_kb.py
+(même encodeur, même fenêtre de contexte, même pooling).
+Dans config.cfg (avec --code cli/ann_index.py) :
+[components.entity_linker.get_candidates]
+@misc = "dodis.AnnFallbackCandidates.v1"
+index_path = "../kb/ann_index"
+k = 10
+
+Usage:
+python cli/ann_index.py build --kb ./kb_exported
+python cli/ann_index.py bench --kb ./kb_exported --k 10 --nprobe 1 4 16 64
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+import warnings
+from typing import Callable, Iterable, List, Tuple, Union
+
+import numpy as np
+import spacy
+from spacy.kb import Candidate, InMemoryLookupKB, KnowledgeBase
+from spacy.tokens import Span
+
+# réglages de meta.json qui déterminent l'encodage d'une requête (copiés dans cfg.json)
+QUERY_SETTINGS = {"encoder": "bert-base-german-cased", "encoder_backend": "hf", "encoder_id": None, "max_length": 128,
+                  "context_sents": 0, "context_tokens": 0, "pooling": "context", "pool_window": 0}
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def spherical_kmeans(vectors: np.ndarray, n_lists: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Centroïdes (normalisés) des vecteurs normalisés ; une liste vide est réinitialisée sur un vecteur tiré au hasard
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = assign_lists(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=n_lists)
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 8192) -> np.ndarray:
+    return np.concatenate([(vectors[i : i + chunk] @ centroids.T).argmax(axis=1)
+                           for i in range(0, len(vectors), chunk)]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices des k meilleurs scores, triés par score décroissant
+    """
+    k = min(k, len(scores))
+    best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    return best[np.argsort(-scores[best], kind="stable")]
+
+
+class IVFIndex:
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, rows: np.ndarray, vectors: np.ndarray,
+                 entities: List[str], cfg: dict = None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.vectors = vectors
+        self.entities = entities
+        self.cfg = cfg or {}
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, entities: List[str], n_lists: int = 0, n_iter: int = 20, seed: int = 0,
+              train_size: int = 100_000, cfg: dict = None) -> "IVFIndex":
+        """
+        n_lists = 0 : environ 4·√n listes
+        """
+        vectors = normalize(vectors)
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+        rng = np.random.default_rng(seed)
+        train = vectors if len(vectors) <= train_size else vectors[rng.choice(len(vectors), train_size, replace=False)]
+        centroids = spherical_kmeans(train, n_lists, n_iter, seed)
+        assign = assign_lists(vectors, centroids)
+        rows = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))]).astype(np.int64)
+        cfg = dict(cfg or {}, dim=int(vectors.shape[1]), n_lists=int(n_lists))
+        return cls(centroids, offsets, rows, vectors[rows], entities, cfg)
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: int = 8) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pour chaque requête, lignes des k entités les plus proches (-1 si moins de k candidats) et leurs similarités
+        """
+        queries = normalize(np.atleast_2d(queries))
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        out_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        out_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, (query, lists) in enumerate(zip(queries, probes)):
+            positions = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            if not len(positions):
+                continue
+            scores = self.vectors[positions] @ query
+            best = top_k(scores, k)
+            out_rows[q, : len(best)] = self.rows[positions[best]]
+            out_scores[q, : len(best)] = scores[best]
+        return out_rows, out_scores
+
+    def query(self, vector: np.ndarray, k: int = 10, nprobe: int = 8) -> List[Tuple[str, float]]:
+        """
+        Les k entités les plus proches d'un vecteur : [(kb_id, similarité cosinus), ...]
+        """
+        rows, scores = self.search(vector, k, nprobe)
+        return [(self.entities[r], float(s)) for r, s in zip(rows[0], scores[0]) if r >= 0]
+
+    def to_disk(self, path: Union[str, Path]):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ("centroids", "offsets", "rows", "vectors"):
+            np.save(path / f"{name}.npy", getattr(self, name))
+        (path / "entities.json").write_text(json.dumps(self.entities, ensure_ascii=False), "utf-8")
+        (path / "cfg.json").write_text(json.dumps(self.cfg, indent=2), "utf-8")
+
+    @classmethod
+    def from_disk(cls, path: Union[str, Path]) -> "IVFIndex":
+        path = Path(path)
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ("centroids", "offsets", "rows", "vectors")}
+        return cls(entities=json.loads((path / "entities.json").read_text("utf-8")),
+                   cfg=json.loads((path / "cfg.json").read_text("utf-8")), **arrays)
+
+
+def build_kb_index(kb_dir: Path, n_lists: int = 0, n_iter: int = 20, seed: int = 0) -> IVFIndex:
+    """
+    Construit et enregistre <kb>/ann_index ; les paramètres sont gardés dans cfg.json pour update_kb.py
+    """
+    entities, vectors, meta = load_kb_vectors(kb_dir)
+    cfg = {name: meta.get(name, default) for name, default in QUERY_SETTINGS.items()}
+    index = IVFIndex.build(vectors, entities, n_lists, n_iter, seed,
+                           cfg=dict(cfg, requested_lists=n_lists, n_iter=n_iter, seed=seed))
+    index.to_disk(kb_dir / "ann_index")
+    return index
+
+
+def exact_search(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """
+    Recherche exhaustive (référence du rappel) : lignes des k vecteurs les plus proches de chaque requête
+    """
+    scores = normalize(np.atleast_2d(queries)) @ normalize(vectors).T
+    return np.stack([top_k(s, k) for s in scores])
+
+
+def load_kb_vectors(kb_dir: Path) -> Tuple[List[str], np.ndarray, dict]:
+    meta = json.loads((kb_dir / "meta.json").read_text("utf-8"))
+    kb = InMemoryLookupKB(vocab=spacy.blank("de").vocab, entity_vector_length=meta["vec"])
+    kb.from_disk(kb_dir / "dodis_kb")
+    entities = list(kb.get_entity_strings())
+    vectors = np.array([kb.get_vector(e) for e in entities], dtype=np.float32).reshape(-1, meta["vec"])
+    return entities, vectors, meta
+
+
+def benchmark(index: IVFIndex, vectors: np.ndarray, queries: np.ndarray, k: int, nprobes: List[int]):
+    exact = exact_search(vectors, queries, k)
+    start = time.perf_counter()
+    exact_search(vectors, queries, k)
+    exact_qps = len(queries) / (time.perf_counter() - start)
+    print(f"{'nprobe':>8} {'recall@' + str(k):>10} {'req/s':>10}")
+    print(f"{'exact':>8} {1.0:>10.4f} {exact_qps:>10.1f}")
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        rows, _ = index.search(queries, k, nprobe)
+        qps = len(queries) / (time.perf_counter() - start)
+        recall = np.mean([len(set(r[r >= 0]) & set(e)) / len(e) for r, e in zip(rows, exact)])
+        print(f"{nprobe:>8} {recall:>10.4f} {qps:>10.1f}")
+
+
+# ----------- générateur de candidats de secours -----------
+
+class AnnFallback:
+    """
+    Candidats des alias de la KB ; pour une mention sans alias connu, les k entités les plus proches
+    de l'encodage de son contexte (prior nul, la similarité du modèle départage)
+    """
+
+    def __init__(self, index_path: Union[str, Path], k: int = 10, nprobe: int = 8):
+        self.index = IVFIndex.from_disk(index_path)
+        self.k = k
+        self.nprobe = nprobe
+        self.settings = {name: self.index.cfg.get(name, default) for name, default in QUERY_SETTINGS.items()}
+        self.encoder = None
+
+    def load_encoder(self):
+        from encoders import get_encoder
+
+        settings = self.settings
+        self.encoder = get_encoder(settings["encoder"], settings["encoder_backend"])
+        if settings["encoder_id"] and self.encoder.id != settings["encoder_id"]:
+            warnings.warn(f"Encodeur {self.encoder.id} différent de celui de la KB ({settings['encoder_id']}) : "
+                          f"reconstruire la KB ou l'index")
+
+    def encode(self, mentions: List[Span]) -> np.ndarray:
+        """
+        Vecteurs des contextes des mentions, construits comme ceux des entités par build_kb.py
+        """
+        from build_kb import SentenceIndex
+        from encoders import PIPELINE_BACKEND
+
+        if self.encoder is None:
+            self.load_encoder()
+        settings = self.settings
+        sentences, contexts, bounds = {}, [], []
+        for m in mentions:
+            if id(m.doc) not in sentences:
+                sentences[id(m.doc)] = SentenceIndex(m.doc)
+            context, token_bounds = sentences[id(m.doc)].mention_context(
+                m, settings["context_sents"], settings["context_tokens"], settings["pooling"], settings["pool_window"])
+            contexts.append(context)
+            bounds.append(token_bounds)
+        if settings["encoder_backend"] == PIPELINE_BACKEND:
+            # comme embed_doc_contexts : une passe du transformer par doc, puis moyenne des tokens du contexte
+            docs = {key: index.doc for key, index in sentences.items()}
+            passed = dict(zip(docs, self.encoder.nlp.pipe(doc.copy() for doc in docs.values())))
+            return np.concatenate([self.encoder.pool(passed[id(m.doc)], [b]) for m, b in zip(mentions, bounds)])
+        if settings["pooling"] == "mention":
+            return self.encoder.embed_spans([c[0] for c in contexts], [c[1:] for c in contexts],
+                                            max_length=settings["max_length"])
+        return self.encoder.embed_batch(contexts, max_length=settings["max_length"])
+
+    def dense_candidates(self, kb: KnowledgeBase, mentions: List[Span]) -> List[List[Candidate]]:
+        rows, _ = self.index.search(self.encode(mentions), self.k, self.nprobe)
+        out = []
+        for mention, mention_rows in zip(mentions, rows):
+            alias_hash = kb.vocab.strings.add(mention.text)
+            candidates = []
+            for row in mention_rows[mention_rows >= 0]:
+                entity = self.index.entities[row]
+                candidates.append(Candidate(kb=kb, entity_hash=kb.vocab.strings.add(entity), entity_freq=0.0,
+                                            entity_vector=kb.get_vector(entity), alias_hash=alias_hash, prior_prob=0.0))
+            out.append(candidates)
+        return out
+
+    def __call__(self, kb: KnowledgeBase, mention: Span) -> List[Candidate]:
+        return self.batch(kb, [mention])[0]
+
+    def batch(self, kb: KnowledgeBase, mentions: Iterable[Span]) -> List[List[Candidate]]:
+        mentions = list(mentions)
+        candidates = [list(kb.get_candidates(m)) for m in mentions]
+        missing = [i for i, c in enumerate(candidates) if not c]
+        if missing:
+            for i, dense in zip(missing, self.dense_candidates(kb, [mentions[i] for i in missing])):
+                candidates[i] = dense
+        return candidates
+
+
+@spacy.registry.misc("dodis.AnnFallbackCandidates.v1")
+def create_ann_fallback(index_path: Path, k: int = 10, nprobe: int = 8) -> Callable[[KnowledgeBase, Span], List[Candidate]]:
+    return AnnFallback(index_path, k, nprobe)
+
+
+@spacy.registry.misc("dodis.AnnFallbackCandidatesBatch.v1")
+def create_ann_fallback_batch(index_path: Path, k: int = 10, nprobe: int = 8) -> Callable:
+    # une seule passe d'encodage pour les mentions sans alias d'un lot (candidates_batch_size > 1)
+    return AnnFallback(index_path, k, nprobe).batch
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index IVF des vecteurs d'entités de la KB")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Construit <kb>/ann_index")
+    build.add_argument("--kb", required=True, help="Dossier de sortie de build_kb.py")
+    build.add_argument("--n-lists", type=int, default=0, help="Nombre de listes (0 = environ 4·√n)")
+    build.add_argument("--n-iter", type=int, default=20)
+    build.add_argument("--seed", type=int, default=0)
+    bench = sub.add_parser("bench", help="Rappel@k par rapport à la recherche exacte et requêtes/s")
+    bench.add_argument("--kb", required=True)
+    bench.add_argument("--k", type=int, default=10)
+    bench.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    bench.add_argument("--queries", type=int, default=1000, help="Requêtes : vecteurs d'entités tirés et bruités")
+    bench.add_argument("--noise", type=float, default=0.5, help="Écart-type du bruit relatif à la norme")
+    bench.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    kb_dir = Path(args.kb)
+    if args.command == "build":
+        start = time.perf_counter()
+        index = build_kb_index(kb_dir, args.n_lists, args.n_iter, args.seed)
+        print(f"Index de {len(index.entities)} entités, {index.cfg['n_lists']} listes, "
+              f"{time.perf_counter() - start:.1f} s → {kb_dir / 'ann_index'}")
+    else:
+        entities, vectors, meta = load_kb_vectors(kb_dir)
+        index = IVFIndex.from_disk(kb_dir / "ann_index")
+        rng = np.random.default_rng(args.seed)
+        picked = normalize(vectors[rng.choice(len(vectors), args.queries)])
+        noise = rng.normal(size=picked.shape).astype(np.float32) * args.noise / np.sqrt(picked.shape[1])
+        benchmark(index, vectors, picked + noise, args.k, args.nprobe)
@@ -0,0 +1,56 @@
+import random
+import time
+from typing import List
+
+import spacy
+import typer
+from spacy.tokens import Span
+
+from ner_create import customize_tokenizer, remove_overlapping
+
+"""
+Benchmark de remove_overlapping sur des paragraphes synthétiques contenant de plus en plus de spans.
+
+Usage:
+python cli/bench_remove_overlapping.py --sizes 100 --sizes 400 --sizes 1600 --sizes 6400
+"""
+
+WORDS = ["Bundesrat", "Schweiz", "Bern", "Genf", "Motta", "Völkerbund", "PLO", "PLO-Büro", "und", "der", "in"]
+
+
+def make_doc(nlp, n_spans: int, rng: random.Random):
+    """
+    Paragraphe synthétique avec environ n_spans spans (chevauchements, doublons et mots collés inclus)
+    """
+    words = [rng.choice(WORDS) for _ in range(n_spans * 2)]
+    # quelques mots collés pour déclencher les splits
+    for i in range(0, len(words) - 1, 17):
+        words[i] = words[i] + words[i + 1]
+    doc = nlp(" ".join(words))
+    ents = []
+    for _ in range(n_spans):
+        start = rng.randrange(len(doc))
+        end = min(len(doc), start + rng.randint(1, 4))
+        ents.append(Span(doc, start, end, label=rng.choice(["PER", "LOC", "ORG"])))
+    return ents
+
+
+def bench(sizes: List[int] = typer.Option([100, 200, 400, 800, 1600]), repeat: int = 5, seed: int = 0):
+    """
+    Mesure le temps moyen de remove_overlapping par paragraphe pour chaque nombre de spans
+    """
+    nlp = spacy.blank("de")
+    customize_tokenizer(nlp)
+    rng = random.Random(seed)
+    print(f"{'spans':>8} {'ms/paragraphe':>14} {'µs/span':>10}")
+    for size in sizes:
+        ents = make_doc(nlp, size, rng)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            remove_overlapping(ents)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{len(ents):>8} {elapsed * 1000:>14.2f} {elapsed / max(len(ents), 1) * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    typer.run(bench)
@@ -1,15 +1,27 @@
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
+import random
+from bisect import bisect_right
 from pathlib import Path
 from collections import defaultdict, Counter
-from typing import List, Dict, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Iterator, List, Sequence, Tuple, Union
 
 import numpy as np
 import spacy
-from spacy.tokens import DocBin
+from spacy.tokens import Doc, DocBin, Span
 from spacy.kb import InMemoryLookupKB
-from transformers import AutoModel, AutoTokenizer
-import torch
+from spacy.vocab import Vocab
+
+from alias_index import AliasIndex
+from dodis_ids import UNTYPED, entity_type
+from embedding_cache import EmbeddingCache
+from encoders import (BACKENDS, DEFAULT_ENCODER, DEFAULT_ONNX_DIR, PIPELINE_BACKEND, HFEncoder, PipelineEncoder, get_encoder,
+                      set_torch_threads)
 
 """
 Usage:
@@ -18,24 +30,313 @@ python cli/build_kb_from_spacy.py \
     --output ./kb_exported
 """
 
-# ------------ CONFIGURATION HF ENCODER -------------
-HF_MODEL = "bert-base-german-cased"
-_tokenizer = AutoTokenizer.from_pretrained(HF_MODEL)
-_model = AutoModel.from_pretrained(HF_MODEL)
-_model.eval()
-
-def embed_batch(texts: List[str], max_length: int = 128) -> np.ndarray:
-    with torch.no_grad():
-        toks = _tokenizer(texts, return_tensors="pt", truncation=True, padding=True, max_length=max_length)
-        outs = _model(**toks).last_hidden_state
-        mask = toks["attention_mask"]
-        summed = (outs * mask.unsqueeze(-1)).sum(dim=1)
-        denom = mask.sum(dim=1, keepdim=True).clamp(min=1e-9)
-        return (summed / denom).cpu().numpy()
+# longueur maximale des contextes en wordpieces (meta.json, reprise par ann_index.py pour les requêtes)
+MAX_LENGTH = 128
+
+# encodeur propre à chaque processus de travail
+_worker_encoder = None
+
+def _init_embed_worker(encoder_name: str, backend: str, threads: int, options: dict):
+    global _worker_encoder
+    set_torch_threads(threads)
+    _worker_encoder = get_encoder(encoder_name, backend, threads=threads, **options)
+
+def _embed_task(encoder: HFEncoder, texts: List[str], max_length: int, spans: List[Tuple[int, int]] = None):
+    try:
+        if spans is not None:
+            return encoder.embed_spans(texts, spans, max_length=max_length), None
+        return encoder.embed_batch(texts, max_length=max_length), None
+    except Exception as exc:
+        return None, str(exc)
+
+def _embed_worker(args: tuple):
+    return _embed_task(_worker_encoder, *args)
+
+def context_key(cache: EmbeddingCache, encoder_id: str, max_length: int, context) -> str:
+    # contexte : texte, ou (texte, début, fin) pour un vecteur de mention
+    if isinstance(context, str):
+        return cache.key(encoder_id, max_length, context)
+    return cache.key(encoder_id, max_length, context[0], context[1:])
+
+def embed_contexts(encoder: HFEncoder, texts: List[str], batch_size: int, logger: logging.Logger, max_length: int = MAX_LENGTH,
+                   cache: EmbeddingCache = None, workers: int = 1, threads: int = 0,
+                   encoder_options: dict = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Encode chaque contexte unique une seule fois, par lots pleins de longueurs voisines (tri par nombre de tokens).
+    Contextes (texte, début, fin) : vecteurs de mentions ; les lots regroupent `batch_size` textes distincts
+    avec toutes leurs mentions, chaque texte n'est donc encodé qu'une fois.
+    Avec un cache, les contextes déjà encodés y sont relus et chaque lot encodé y est ajouté aussitôt.
+    Avec workers > 1, les lots sont répartis entre processus (chacun limité à `threads` threads torch)
+    et les résultats relus dans l'ordre des lots.
+    Produit au fil de l'eau (indices dans `texts`, vecteurs) ; les lots en échec sont seulement signalés.
+    """
+    encoded = np.zeros(len(texts), dtype=bool)
+    keys = None
+    if cache is not None:
+        keys = [context_key(cache, encoder.id, max_length, text) for text in texts]
+        found = cache.get_many(keys)
+        hits = [j for j, key in enumerate(keys) if key in found]
+        logger.info(f"  {len(hits)}/{len(texts)} contextes relus depuis le cache d'embeddings")
+        if hits:
+            encoded[hits] = True
+            yield np.array(hits), np.stack([found[keys[j]] for j in hits])
+        del found
+    todo = np.flatnonzero(~encoded)
+    if not len(todo):
+        return
+    if isinstance(texts[todo[0]], str):
+        order = todo[np.argsort(encoder.token_lengths([texts[j] for j in todo], max_length), kind="stable")]
+        batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+        tasks = (([texts[j] for j in idx], max_length) for idx in batches)
+    else:
+        mentions = defaultdict(list)
+        for j in todo:
+            mentions[texts[j][0]].append(j)
+        unique = list(mentions)
+        unique = [unique[i] for i in np.argsort(encoder.token_lengths(unique, max_length), kind="stable")]
+        batches = [np.array([j for text in unique[i : i + batch_size] for j in mentions[text]])
+                   for i in range(0, len(unique), batch_size)]
+        logger.info(f"  {len(todo)} mentions dans {len(unique)} textes distincts")
+        tasks = (([texts[j][0] for j in idx], max_length, [texts[j][1:] for j in idx]) for idx in batches)
+
+    executor = None
+    if workers > 1:
+        threads = threads or max((os.cpu_count() or 1) // workers, 1)
+        logger.info(f"  {workers} processus d'encodage × {threads} threads torch")
+        # spawn : pas de fork d'un processus où torch est déjà initialisé
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_embed_worker,
+                                       initargs=(encoder.name, encoder.backend, threads, encoder_options or {}))
+        results = executor.map(_embed_worker, tasks)
+    else:
+        if threads:
+            set_torch_threads(threads)
+        results = (_embed_task(encoder, *task) for task in tasks)
+
+    try:
+        n_done = 0
+        for n_batch, (idx, (batch_vectors, error)) in enumerate(zip(batches, results)):
+            n_done += len(idx)
+            if error is not None:
+                logger.warning(f"Encodage batch {n_batch} échoué → {error}")
+                continue
+            if cache is not None:
+                cache.put_many([keys[j] for j in idx], batch_vectors)
+            if (n_batch + 1) % 100 == 0:
+                logger.info(f"  {n_done}/{len(todo)} contextes encodés...")
+            yield idx, batch_vectors
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def embed_doc_contexts(encoder: PipelineEncoder, texts: List[str], batch_size: int, logger: logging.Logger,
+                       cache: EmbeddingCache = None, threads: int = 0, spacy_paths: Sequence[Path] = (),
+                       locations: List[tuple] = (), **options) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Variante d'embed_contexts pour le transformer d'un pipeline : chaque doc des DocBin qui porte des contextes
+    à encoder passe une fois dans nlp.pipe, puis chaque contexte est la moyenne des wordpieces de ses tokens
+    (location = (fichier, doc, début, fin), première occurrence du texte ; la mention et sa fenêtre avec
+    --pooling mention). Les clés du cache sont celles d'embed_contexts.
+    """
+    encoded = np.zeros(len(texts), dtype=bool)
+    keys = None
+    if cache is not None:
+        keys = [context_key(cache, encoder.id, 0, text) for text in texts]
+        found = cache.get_many(keys)
+        hits = [j for j, key in enumerate(keys) if key in found]
+        logger.info(f"  {len(hits)}/{len(texts)} contextes relus depuis le cache d'embeddings")
+        if hits:
+            encoded[hits] = True
+            yield np.array(hits), np.stack([found[keys[j]] for j in hits])
+        del found
+    todo = defaultdict(lambda: defaultdict(list))
+    for j in np.flatnonzero(~encoded):
+        file_idx, doc_idx, _, _ = locations[j]
+        todo[file_idx][doc_idx].append(j)
+    if not todo:
+        return
+    if threads:
+        set_torch_threads(threads)
+    if options.get("workers", 1) > 1:
+        logger.info("  --embed-workers ignoré avec le transformer du pipeline (un seul processus)")
+
+    n_docs, n_done = 0, 0
+    for file_idx, needed in sorted(todo.items()):
+        docs = DocBin().from_disk(str(spacy_paths[file_idx])).get_docs(encoder.nlp.vocab)
+        pairs = ((doc, doc_idx) for doc_idx, doc in enumerate(docs) if doc_idx in needed)
+        for doc, doc_idx in encoder.nlp.pipe(pairs, as_tuples=True, batch_size=batch_size):
+            idx = np.array(needed[doc_idx])
+            try:
+                batch_vectors = encoder.pool(doc, [locations[j][2:] for j in idx])
+            except Exception as exc:
+                logger.warning(f"Encodage doc {doc_idx} de {spacy_paths[file_idx]} échoué → {exc}")
+                continue
+            if cache is not None:
+                cache.put_many([keys[j] for j in idx], batch_vectors)
+            n_docs += 1
+            n_done += len(idx)
+            if n_docs % 1000 == 0:
+                logger.info(f"  {n_docs} docs, {n_done} contextes encodés...")
+            yield idx, batch_vectors
+
+class ContextReservoir:
+    """
+    Échantillon uniforme d'au plus `cap` contextes par entité (algorithme R, générateur initialisé par `seed`),
+    cap = 0 : tous les contextes.
+    Les textes sont partagés entre entités et comptés par référence : un texte sorti de tous les échantillons est oublié,
+    la mémoire dépend donc du nombre d'entités et non du nombre de mentions.
+    Un contexte est un texte, ou (texte, début, fin) quand le vecteur est celui de la mention (--pooling mention).
+    """
+
+    def __init__(self, cap: int = 0, seed: int = 0):
+        self.cap = cap
+        self.rng = random.Random(seed)
+        self.ids: Dict[str, int] = {}
+        self.texts: Dict[int, str] = {}
+        self.locations: Dict[int, tuple] = {}
+        self.refs: Dict[int, int] = {}
+        self.samples: Dict[str, List[int]] = defaultdict(list)
+        self.seen = Counter()
+        self.next_id = 0
+
+    def add(self, eid: str, text: str, location: tuple = None):
+        self.seen[eid] += 1
+        sample = self.samples[eid]
+        if not self.cap or len(sample) < self.cap:
+            sample.append(self.ref(text, location))
+            return
+        j = self.rng.randrange(self.seen[eid])
+        if j < self.cap:
+            old = sample[j]
+            sample[j] = self.ref(text, location)
+            self.unref(old)
+
+    def ref(self, text: str, location: tuple = None) -> int:
+        i = self.ids.get(text)
+        if i is None:
+            i = self.ids[text] = self.next_id
+            self.texts[i] = text
+            # première occurrence du texte : (fichier, doc, premier token, fin) dans les DocBin lus
+            self.locations[i] = location
+            self.refs[i] = 0
+            self.next_id += 1
+        self.refs[i] += 1
+        return i
+
+    def unref(self, i: int):
+        self.refs[i] -= 1
+        if not self.refs[i]:
+            del self.ids[self.texts.pop(i)]
+            del self.locations[i]
+            del self.refs[i]
+
+    def __len__(self):
+        return len(self.texts)
+
+    def compact(self, entity_ids: List[str]) -> Tuple[List[str], List[List[int]]]:
+        """
+        Textes retenus (sans trou) et, pour chaque contexte, les lignes des entités qui l'utilisent (une par mention tirée)
+        """
+        position = {i: p for p, i in enumerate(self.texts)}
+        users = [[] for _ in position]
+        for row, eid in enumerate(entity_ids):
+            for i in self.samples[eid]:
+                users[position[i]].append(row)
+        return list(self.texts.values()), users
+
+class RunningMean:
+    """
+    Moyenne par entité accumulée au fil des lots (somme et effectif), sans garder les vecteurs de contextes
+    """
+
+    def __init__(self, n_rows: int, dim: int):
+        self.sums = np.zeros((n_rows, dim), dtype=np.float64)
+        self.counts = np.zeros(n_rows, dtype=np.int64)
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray):
+        np.add.at(self.sums, rows, vectors)
+        np.add.at(self.counts, rows, 1)
+
+    def means(self) -> np.ndarray:
+        return (self.sums / np.maximum(self.counts, 1)[:, None]).astype(np.float32)
+
 
 def clean_alias(alias: str) -> str:
     return alias.strip().replace("\u00A0", " ")
 
+class SentenceIndex:
+    """
+    Bornes des phrases d'un doc, calculées une fois : la phrase d'une mention est trouvée par bisection.
+    """
+
+    def __init__(self, doc: Doc):
+        self.doc = doc
+        # bornes issues des annotations du DocBin ; sans elles, le contexte est le doc entier
+        self.sents = list(doc.sents) if doc.has_annotation("SENT_START") else []
+        self.starts = [s.start for s in self.sents]
+
+    def sentence_of(self, token_i: int) -> int:
+        return bisect_right(self.starts, token_i) - 1
+
+    def bounds(self, ent: Span, context_sents: int = 0, context_tokens: int = 0) -> Tuple[int, int]:
+        """
+        Tokens [début, fin) du contexte de la mention :
+        - par défaut, la phrase qui la contient (ou le doc entier à défaut) ;
+        - context_sents > 0 : avec en plus N phrases de chaque côté ;
+        - context_tokens > 0 : fenêtre d'environ N tokens centrée sur la mention (remplace la fenêtre de phrases).
+        """
+        doc = self.doc
+        if context_tokens > 0:
+            margin = max(context_tokens - len(ent), 0) // 2
+            return max(ent.start - margin, 0), min(ent.end + margin, len(doc))
+        i = self.sentence_of(ent.start)
+        if i < 0:
+            return 0, len(doc)
+        first = self.sents[max(i - context_sents, 0)]
+        last = self.sents[min(i + context_sents, len(self.sents) - 1)]
+        return first.start, last.end
+
+    def context(self, ent: Span, context_sents: int = 0, context_tokens: int = 0) -> Tuple[str, Tuple[int, int]]:
+        """
+        Texte et bornes du contexte de la mention (voir bounds)
+        """
+        start, end = self.bounds(ent, context_sents, context_tokens)
+        if context_tokens <= 0 and not self.sents:
+            return self.doc.text, (start, end)
+        return self.doc[start:end].text, (start, end)
+
+    def mention_context(self, ent: Span, context_sents: int = 0, context_tokens: int = 0, pooling: str = "context",
+                        pool_window: int = 0) -> Tuple[Union[str, tuple], Tuple[int, int]]:
+        """
+        Contexte à encoder pour la mention et ses tokens [début, fin) à moyenner :
+        le texte du contexte, ou avec pooling = "mention" (texte, début, fin) en caractères,
+        la mention élargie de `pool_window` tokens de chaque côté sans sortir du contexte
+        """
+        context, (start, end) = self.context(ent, context_sents, context_tokens)
+        if pooling != "mention":
+            return context, (start, end)
+        doc = self.doc
+        lo, hi = max(ent.start - pool_window, start), min(ent.end + pool_window, end)
+        offset = doc[start].idx
+        return (context, doc[lo].idx - offset, doc[hi - 1].idx + len(doc[hi - 1]) - offset), (lo, hi)
+
+def load_vocab(nlp_model: str, vocab_only: bool = False) -> Vocab:
+    """
+    Vocabulaire utilisé pour relire les DocBin et construire la KB.
+    vocab_only : pipeline vide de même langue (+ dossier vocab/ du modèle s'il s'agit d'un chemin),
+    sans charger transformer ni parser ; les phrases viennent de toute façon des annotations des DocBin.
+    """
+    if not vocab_only:
+        return spacy.load(nlp_model, disable=["ner", "entity_linker"]).vocab
+    model_dir = Path(nlp_model)
+    lang = "de"
+    if (model_dir / "meta.json").exists():
+        lang = json.loads((model_dir / "meta.json").read_text("utf-8")).get("lang", lang)
+    nlp = spacy.blank(lang)
+    if (model_dir / "vocab" / "strings.json").exists():
+        nlp.vocab.from_disk(model_dir / "vocab")
+    return nlp.vocab
+
 def pad_vec(vec: np.ndarray, dim: int) -> np.ndarray:
     if vec.shape[0] == dim:
         return vec
@@ -47,34 +348,26 @@ def pad_vec(vec: np.ndarray, dim: int) -> np.ndarray:
 
 # ------------- KB BUILDER FROM SPACY ---------------
 
-def build_kb_from_spacy(
-    spacy_paths: Sequence[Path],
-    kb_dir: Path,
-    nlp_model: str = "de_dep_news_trf",
-    desc_file: str = "descriptions.json",
-    batch_size: int = 32,
-    log_level: str = "INFO"
-):
-    logging.basicConfig(level=getattr(logging, log_level.upper(), logging.INFO))
-    logger = logging.getLogger("spacy_kb_builder")
-
-    nlp = spacy.load(nlp_model, disable=["ner", "entity_linker"])
-    kb_dir = Path(kb_dir)
-    kb_dir.mkdir(parents=True, exist_ok=True)
-
-    # --- Extraction phase ---
+def extract_mentions(spacy_paths: Sequence[Path], vocab: Vocab, reservoir: ContextReservoir, logger: logging.Logger,
+                     context_sents: int = 0, context_tokens: int = 0, pooling: str = "context", pool_window: int = 0):
+    """
+    Étape 1 : mentions liées (kb_id) des DocBin ; leurs contextes vont dans `reservoir`.
+    pooling = "mention" : le contexte est (texte, début, fin) en caractères (SentenceIndex.mention_context),
+    pour un vecteur moyenné sur les seuls wordpieces de la mention.
+    Retourne (fréquence par entité, alias -> entité -> nombre, descriptions, nombre de mentions)
+    """
     freq = Counter()
     alias2ent2f = defaultdict(lambda: defaultdict(int))
     desc: Dict[str, str] = {}
-    entity_contexts: Dict[str, List[str]] = defaultdict(list)
     n_mentions = 0
 
     logger.info("Étape 1/4 : extraction contextes et alias depuis .spacy...")
-    for path in spacy_paths:
+    for file_idx, path in enumerate(spacy_paths):
         logger.info(f"  → Fichier : {path}")
         db = DocBin().from_disk(str(path))
-        docs = list(db.get_docs(nlp.vocab))
+        docs = list(db.get_docs(vocab))
         for doc_idx, doc in enumerate(docs):
+            sentences = None
             for ent in doc.ents:
                 kb_id = ent.kb_id_ if hasattr(ent, "kb_id_") else None
                 if not kb_id or not ent.text.strip():
@@ -84,24 +377,153 @@ def build_kb_from_spacy(
                 freq[eid] += 1
                 alias2ent2f[mention][eid] += 1
                 desc.setdefault(eid, mention)
-                # Cherche le contexte : la phrase contenant la mention, ou fallback texte
-                sent = next((s for s in doc.sents if s.start_char <= ent.start_char < s.end_char), None)
-                context = sent.text if sent else doc.text
-                entity_contexts[eid].append(context)
+                # Cherche le contexte : la phrase contenant la mention (ou sa fenêtre), ou fallback texte
+                if sentences is None:
+                    sentences = SentenceIndex(doc)
+                context, (start, end) = sentences.mention_context(ent, context_sents, context_tokens,
+                                                                  pooling, pool_window)
+                reservoir.add(eid, context, (file_idx, doc_idx, start, end))
                 n_mentions += 1
             if (doc_idx+1) % 10000 == 0:
                 logger.info(f"  {doc_idx+1} docs traités...")
 
     logger.info(f"{n_mentions} mentions extraites")
-    logger.info(f"{len(entity_contexts)} entités uniques pour contextualisation")
+    logger.info(f"{len(reservoir.samples)} entités uniques pour contextualisation")
+    logger.info(f"{len(reservoir)} contextes uniques à encoder")
+    return freq, alias2ent2f, desc, n_mentions
 
-    # --- Export stats/contrôle ---
-    export_stats = {
+def encode_entities(reservoir: ContextReservoir, encoder: HFEncoder, batch_size: int, logger: logging.Logger,
+                    cache_dir: Path = None, cache_max_entries: int = 0, spacy_paths: Sequence[Path] = None,
+                    **embed_options):
+    """
+    Étape 2 : encode les contextes échantillonnés et retourne (entités, vecteurs moyens, nombre de vecteurs par entité).
+    Avec le transformer d'un pipeline, les contextes sont relus dans les docs de spacy_paths (ceux d'extract_mentions)
+    """
+    entity_ids = list(reservoir.samples)
+    contexts, users = reservoir.compact(entity_ids)
+    aggregator = RunningMean(len(entity_ids), encoder.dim)
+    if isinstance(encoder, PipelineEncoder) and spacy_paths is not None:
+        embed = partial(embed_doc_contexts, encoder, spacy_paths=spacy_paths,
+                        locations=list(reservoir.locations.values()))
+    else:
+        embed = partial(embed_contexts, encoder)
+
+    def aggregate(batches):
+        # redistribution de chaque lot de vecteurs de contextes vers les entités qui les utilisent
+        for idx, batch_vectors in batches:
+            rows = [users[j] for j in idx]
+            aggregator.add(np.concatenate(rows).astype(np.int64),
+                           np.repeat(batch_vectors, [len(r) for r in rows], axis=0))
+
+    if cache_dir:
+        with EmbeddingCache(cache_dir, encoder.dim, cache_max_entries) as cache:
+            aggregate(embed(contexts, batch_size, logger, cache=cache, **embed_options))
+    else:
+        aggregate(embed(contexts, batch_size, logger, **embed_options))
+    return entity_ids, aggregator.means(), aggregator.counts
+
+def alias_priors(cand: Dict[str, int]) -> Tuple[List[str], List[float]]:
+    ents = list(cand)
+    total = sum(cand.values())
+    return ents, [(cand[e] + 1) / (total + len(ents)) for e in ents]
+
+def fill_kb(kb: InMemoryLookupKB, entity_ids: List[str], freqs: List[float], vectors: List[np.ndarray],
+            alias2ent2f: Dict[str, Dict[str, int]], logger: logging.Logger):
+    """
+    Étapes 3 et 4 : entités puis alias (probabilités a priori lissées à partir des comptes)
+    """
+    logger.info("Étape 3/4 : création de la KB (set_entities)...")
+    kb.set_entities(entity_ids, freqs, vectors)
+    logger.info(f"Ajouté {len(entity_ids)} entités à la KB")
+
+    logger.info("Étape 4/4 : insertion des alias...")
+    skipped = 0
+    for alias, cand in alias2ent2f.items():
+        if not alias:
+            skipped += 1
+            continue
+        ents, priors = alias_priors(cand)
+        try:
+            kb.add_alias(alias, ents, priors)
+        except Exception as exc:
+            skipped += 1
+            logger.warning(f"Alias '{alias}' ignoré : {exc}")
+
+    logger.info(f"{skipped} alias ignorés")
+
+def stats_summary(n_mentions: int, freq: Counter, alias2ent2f: Dict[str, Dict[str, int]]) -> dict:
+    return {
         "nb_mentions": n_mentions,
-        "nb_entities": len(entity_contexts),
+        "nb_entities": len(freq),
+        "nb_entities_by_type": dict(Counter(entity_type(eid) or UNTYPED for eid in freq)),
         "top_alias": Counter([alias for alias in alias2ent2f]).most_common(10),
         "top_entity": freq.most_common(10)
     }
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def kb_state(files: Dict[str, str], n_mentions: int, freq: Counter, entity_ids: List[str], counts: Sequence[int],
+             alias2ent2f: Dict[str, Dict[str, int]]) -> dict:
+    """
+    État nécessaire à la mise à jour incrémentale (update_kb.py) : fichiers intégrés (empreinte -> chemin),
+    par entité [mentions, vecteurs moyennés] et comptes bruts des alias (les priors de la KB en sont dérivés)
+    """
+    return {
+        "files": files,
+        "n_mentions": n_mentions,
+        "entities": {eid: [freq[eid], int(count)] for eid, count in zip(entity_ids, counts)},
+        "aliases": {alias: dict(cand) for alias, cand in alias2ent2f.items()},
+    }
+
+def build_kb_from_spacy(
+    spacy_paths: Sequence[Path],
+    kb_dir: Path,
+    nlp_model: str = "de_dep_news_trf",
+    desc_file: str = "descriptions.json",
+    batch_size: int = 32,
+    log_level: str = "INFO",
+    vocab_only: bool = False,
+    context_sents: int = 0,
+    context_tokens: int = 0,
+    encoder_name: str = DEFAULT_ENCODER,
+    encoder_backend: str = "hf",
+    onnx_dir: Path = DEFAULT_ONNX_DIR,
+    stats_only: bool = False,
+    cache_dir: Path = None,
+    cache_max_entries: int = 0,
+    max_contexts: int = 0,
+    seed: int = 0,
+    embed_workers: int = 1,
+    torch_threads: int = 0,
+    embed_source: str = "encoder",
+    pooling: str = "context",
+    pool_window: int = 0
+):
+    logging.basicConfig(level=getattr(logging, log_level.upper(), logging.INFO))
+    logger = logging.getLogger("spacy_kb_builder")
+    if encoder_backend == PIPELINE_BACKEND and embed_source != "pipeline":
+        raise ValueError("Le backend 'pipeline' s'obtient avec embed_source='pipeline' (transformer de nlp_model)")
+    if embed_source == "pipeline":
+        # transformer du pipeline nlp_model, celui que voit l'entity_linker
+        encoder_name, encoder_backend = nlp_model, PIPELINE_BACKEND
+
+    vocab = load_vocab(nlp_model, vocab_only)
+    kb_dir = Path(kb_dir)
+    kb_dir.mkdir(parents=True, exist_ok=True)
+
+    # --- Extraction phase ---
+    # contextes uniques partagés, échantillonnés par entité (au plus max_contexts)
+    reservoir = ContextReservoir(max_contexts, seed)
+    freq, alias2ent2f, desc, n_mentions = extract_mentions(spacy_paths, vocab, reservoir, logger,
+                                                           context_sents, context_tokens, pooling, pool_window)
+
+    # --- Export stats/contrôle ---
+    export_stats = stats_summary(n_mentions, freq, alias2ent2f)
     (kb_dir / "stats.json").write_text(json.dumps(export_stats, indent=2, ensure_ascii=False), "utf-8")
     logger.info("Stats exportées dans stats.json")
     # Exporte les alias pour audit
@@ -112,72 +534,49 @@ def build_kb_from_spacy(
     desc_path = kb_dir / desc_file
     desc_path.write_text(json.dumps(desc, indent=2, ensure_ascii=False), "utf-8")
     logger.info(f"Descriptions sauvegardées dans {desc_path}")
+    if stats_only:
+        logger.info("--stats-only : phases d'encodage et de construction de la KB ignorées")
+        return
 
     # --- Embedding phase ---
-    vec_len = _model.config.hidden_size
-    logger.info(f"Étape 2/4 : encodage contextuel ({vec_len} dimensions, batch={batch_size})...")
-    entity_ids = []
-    freqs = []
+    encoder_options = {"onnx_dir": onnx_dir}
+    encoder = get_encoder(encoder_name, encoder_backend, threads=torch_threads, **encoder_options)
+    vec_len = encoder.dim
+    logger.info(f"Étape 2/4 : encodage contextuel ({encoder.id}, {vec_len} dimensions, batch={batch_size})...")
+    entity_ids, means, counts = encode_entities(reservoir, encoder, batch_size, logger, cache_dir, cache_max_entries,
+                                                spacy_paths, workers=embed_workers, threads=torch_threads,
+                                                encoder_options=encoder_options)
+    del reservoir
+
+    freqs = [float(freq[eid]) for eid in entity_ids]
     vectors = []
     failed_entities = 0
-
-    for eid, contexts in entity_contexts.items():
-        if not contexts:
-            vec = np.zeros(vec_len, dtype=np.float32)
-            logger.warning(f"Aucune occurrence pour {eid} → vecteur nul")
+    for eid, vec, count in zip(entity_ids, means, counts):
+        if not count:
+            logger.warning(f"Aucun embedding valide pour {eid} → vecteur nul")
             failed_entities += 1
-        else:
-            vectors_c = []
-            for i in range(0, len(contexts), batch_size):
-                batch = contexts[i : i + batch_size]
-                try:
-                    v = embed_batch(batch)
-                    vectors_c.extend(v)
-                except Exception as exc:
-                    logger.warning(f"Encodage batch {i//batch_size} pour {eid} échoué → {exc}")
-            if vectors_c:
-                vec = np.mean(vectors_c, axis=0)
-            else:
-                vec = np.zeros(vec_len, dtype=np.float32)
-                logger.warning(f"Aucun embedding valide pour {eid} → vecteur nul")
-                failed_entities += 1
-        entity_ids.append(eid)
-        freqs.append(float(freq[eid]))
         vectors.append(pad_vec(vec, vec_len))
 
     logger.info(f"{failed_entities} entités sans embeddings valides (vecteur nul)")
 
     # --- KB Construction phase ---
-    logger.info("Étape 3/4 : création de la KB (set_entities)...")
-    kb = InMemoryLookupKB(vocab=nlp.vocab, entity_vector_length=vec_len)
-    kb.set_entities(entity_ids, freqs, vectors)
-    logger.info(f"Ajouté {len(entity_ids)} entités à la KB")
-
-    logger.info("Étape 4/4 : insertion des alias...")
-    skipped = 0
-    for alias, cand in alias2ent2f.items():
-        if not alias:
-            skipped += 1
-            continue
-        ents = list(cand)
-        total = sum(cand.values())
-        priors = [(cand[e] + 1) / (total + len(ents)) for e in ents]
-        try:
-            kb.add_alias(alias, ents, priors)
-        except Exception as exc:
-            skipped += 1
-            logger.warning(f"Alias '{alias}' ignoré : {exc}")
-
-    logger.info(f"{skipped} alias ignorés")
+    kb = InMemoryLookupKB(vocab=vocab, entity_vector_length=vec_len)
+    fill_kb(kb, entity_ids, freqs, vectors, alias2ent2f, logger)
 
     # --- Export KB, meta, test reload ---
-    meta = {"vec": vec_len, "model": nlp_model}
+    meta = {"vec": vec_len, "model": nlp_model, "vocab_only": vocab_only, "encoder": encoder_name, "encoder_backend": encoder_backend, "encoder_id": encoder.id, "max_length": MAX_LENGTH, "context_sents": context_sents, "context_tokens": context_tokens, "max_contexts": max_contexts, "seed": seed, "pooling": pooling, "pool_window": pool_window}
     (kb_dir / "meta.json").write_text(json.dumps(meta, indent=2, ensure_ascii=False), "utf-8")
     kb.to_disk(kb_dir / "dodis_kb")
     logger.info("KB sauvegardée dans 'dodis_kb'")
+    files = {file_digest(Path(p)): str(Path(p).resolve()) for p in spacy_paths}
+    state = kb_state(files, n_mentions, freq, entity_ids, counts, alias2ent2f)
+    (kb_dir / "kb_state.json").write_text(json.dumps(state, ensure_ascii=False), "utf-8")
+    alias_index = AliasIndex.from_counts(alias2ent2f, {eid: freq[eid] for eid in entity_ids})
+    alias_index.to_disk(kb_dir / "alias_index")
+    logger.info(f"Index d'alias partitionné par type : {alias_index.cfg['partitions']}")
 
     # Test de rechargement
-    kb_test = InMemoryLookupKB(vocab=nlp.vocab, entity_vector_length=vec_len)
+    kb_test = InMemoryLookupKB(vocab=vocab, entity_vector_length=vec_len)
     kb_test.from_disk(kb_dir / "dodis_kb")
     print("="*60)
     print("Vérification finale KB spaCy :")
@@ -189,6 +588,8 @@ def build_kb_from_spacy(
     print("  - alias_sample.json (20 premiers alias/entités)")
     print("  - descriptions.json")
     print("  - meta.json")
+    print("  - kb_state.json (état pour update_kb.py)")
+    print("  - alias_index (alias normalisés partitionnés par type, pour dodis.TrieCandidates.v1)")
     print("  - dodis_kb (dossier KB binaire spaCy)")
     print("="*60)
     print("Script terminé !")
@@ -200,9 +601,37 @@ if __name__ == "__main__":
     parser.add_argument("--spacy", nargs="+", required=True, help="Fichiers .spacy (train/dev...)")
     parser.add_argument("--output", required=True, help="Dossier où écrire la KB et les exports")
     parser.add_argument("--model", default="de_dep_news_trf", help="Modèle spaCy pour le vocabulaire")
+    parser.add_argument("--vocab-only", action="store_true",
+                        help="Vocabulaire seul (pipeline vide, + vocab/ de --model si c'est un dossier) sans charger le modèle")
     parser.add_argument("--desc-file", default="descriptions.json")
     parser.add_argument("--batch-size", type=int, default=32)
     parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--context-sents", type=int, default=0,
+                        help="Phrases ajoutées de chaque côté de la phrase de la mention")
+    parser.add_argument("--context-tokens", type=int, default=0,
+                        help="Fenêtre de N tokens centrée sur la mention (remplace --context-sents)")
+    parser.add_argument("--encoder", default=DEFAULT_ENCODER, help="Modèle Hugging Face des vecteurs d'entités")
+    parser.add_argument("--embed-source", default="encoder", choices=["encoder", "pipeline"],
+                        help="pipeline : transformer du pipeline --model (doc._.trf_data) au lieu de --encoder")
+    parser.add_argument("--encoder-backend", default="hf", choices=list(BACKENDS),
+                        help="hf (fp32), int8 (quantification dynamique) ou onnx (onnxruntime) ; voir cli/encoders.py")
+    parser.add_argument("--onnx-dir", default=str(DEFAULT_ONNX_DIR), help="Dossier des modèles exportés en ONNX")
+    parser.add_argument("--stats-only", action="store_true",
+                        help="Extraction et statistiques seulement (ni encodeur ni KB)")
+    parser.add_argument("--embedding-cache", default=None,
+                        help="Dossier du cache d'embeddings (reprise et reconstruction incrémentale)")
+    parser.add_argument("--cache-max-entries", type=int, default=2_000_000,
+                        help="Nombre maximal de contextes gardés dans le cache (LRU, 0 = illimité)")
+    parser.add_argument("--max-contexts", type=int, default=0,
+                        help="Contextes tirés au plus par entité (échantillon uniforme, ex. 256 ; 0 = tous)")
+    parser.add_argument("--seed", type=int, default=0, help="Graine de l'échantillonnage des contextes")
+    parser.add_argument("--pooling", default="context", choices=["context", "mention"],
+                        help="mention : vecteur moyenné sur les wordpieces de la mention, chaque phrase encodée une fois")
+    parser.add_argument("--pool-window", type=int, default=0,
+                        help="Tokens ajoutés de chaque côté de la mention avec --pooling mention")
+    parser.add_argument("--embed-workers", type=int, default=1, help="Processus d'encodage en parallèle")
+    parser.add_argument("--torch-threads", type=int, default=0,
+                        help="Threads torch par processus (0 = cœurs disponibles / --embed-workers)")
     args = parser.parse_args()
 
     spacy_paths = [Path(p) for p in args.spacy]
@@ -212,5 +641,21 @@ if __name__ == "__main__":
         nlp_model=args.model,
         desc_file=args.desc_file,
         batch_size=args.batch_size,
-        log_level=args.log_level
+        log_level=args.log_level,
+        vocab_only=args.vocab_only,
+        context_sents=args.context_sents,
+        context_tokens=args.context_tokens,
+        encoder_name=args.encoder,
+        encoder_backend=args.encoder_backend,
+        onnx_dir=Path(args.onnx_dir),
+        stats_only=args.stats_only,
+        cache_dir=Path(args.embedding_cache) if args.embedding_cache else None,
+        cache_max_entries=args.cache_max_entries,
+        max_contexts=args.max_contexts,
+        seed=args.seed,
+        embed_workers=args.embed_workers,
+        torch_threads=args.torch_threads,
+        embed_source=args.embed_source,
+        pooling=args.pooling,
+        pool_window=args.pool_window
     )
@@ -0,0 +1,143 @@
+"""
+Écriture en continu des corpus spaCy (DocBin) en fragments numérotés, avec un manifeste,
+et lecteur de corpus spaCy capable de consommer un tel dossier.
+
+Structure d'un dossier de fragments :
+    ner_traindata/
+        manifest.json
+        shard-00000.spacy
+        shard-00001.spacy
+        ...
+
+Usage à l'entraînement :
+python -m spacy train config.cfg --code cli/docbin_shards.py \
+    --paths.train ./ner_traindata --paths.dev ./ner_devdata
+avec dans config.cfg :
+[corpora.train]
+@readers = "dodis.ShardedCorpus.v1"
+path = ${paths.train}
+"""
+import json
+import os
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Union
+
+import spacy
+from spacy.tokens import Doc, DocBin
+from spacy.training import Corpus
+from spacy.vocab import Vocab
+
+MANIFEST = "manifest.json"
+SHARD_PATTERN = "shard-{:05d}.spacy"
+
+
+class ShardedDocBinWriter:
+    """
+    Ajoute les docs à un DocBin en mémoire et l'écrit sur disque tous les `shard_size` docs.
+    Le manifeste est réécrit (atomiquement) après chaque fragment : un arrêt brutal ne perd que le fragment en cours.
+    """
+
+    def __init__(self, directory: Union[str, Path], shard_size: int = 1000, **docbin_kwargs):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # un nouveau corpus remplace les fragments d'une exécution précédente
+        for old in self.directory.glob("shard-*.spacy"):
+            old.unlink()
+        self.shard_size = shard_size
+        self.docbin_kwargs = docbin_kwargs
+        self.shards = []
+        self.n_docs = 0
+        self.current = DocBin(**docbin_kwargs)
+        self.write_manifest(complete=False)
+
+    def add(self, doc: Doc):
+        self.current.add(doc)
+        if len(self.current) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Écrit le fragment en cours s'il contient des docs
+        """
+        if not len(self.current):
+            return
+        name = SHARD_PATTERN.format(len(self.shards))
+        tmp = self.directory / (name + ".tmp")
+        self.current.to_disk(tmp)
+        os.replace(tmp, self.directory / name)
+        self.shards.append({"file": name, "n_docs": len(self.current)})
+        self.n_docs += len(self.current)
+        self.current = DocBin(**self.docbin_kwargs)
+        self.write_manifest(complete=False)
+
+    def close(self):
+        self.flush()
+        self.write_manifest(complete=True)
+
+    def write_manifest(self, complete: bool):
+        manifest = {
+            "shard_size": self.shard_size,
+            "n_docs": self.n_docs,
+            "complete": complete,
+            "shards": self.shards,
+        }
+        tmp = self.directory / (MANIFEST + ".tmp")
+        tmp.write_text(json.dumps(manifest, indent=2), "utf-8")
+        os.replace(tmp, self.directory / MANIFEST)
+
+    def __len__(self):
+        return self.n_docs + len(self.current)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def shard_paths(directory: Union[str, Path]) -> List[Path]:
+    """
+    Fragments listés dans le manifeste, dans leur ordre d'écriture.
+    Sans manifeste, tous les fichiers .spacy du dossier par ordre alphabétique.
+    """
+    directory = Path(directory)
+    manifest_path = directory / MANIFEST
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text("utf-8"))
+        return [directory / shard["file"] for shard in manifest["shards"]]
+    return sorted(directory.glob("*.spacy"))
+
+
+def read_shards(directory: Union[str, Path], vocab: Vocab) -> Iterator[Doc]:
+    """
+    Lit les docs d'un dossier de fragments, un fragment à la fois
+    """
+    for path in shard_paths(directory):
+        yield from DocBin().from_disk(path).get_docs(vocab)
+
+
+class ShardedCorpus(Corpus):
+    """
+    Corpus spaCy lisant un dossier de fragments dans l'ordre du manifeste (ou un simple fichier .spacy)
+    """
+
+    def read_docbin(self, vocab: Vocab, locs: Iterable[Union[str, Path]]) -> Iterator[Doc]:
+        path = Path(self.path)
+        if path.is_dir():
+            locs = shard_paths(path)
+        return super().read_docbin(vocab, locs)
+
+
+@spacy.registry.readers("dodis.ShardedCorpus.v1")
+def create_sharded_corpus(
+    path: Optional[Path],
+    gold_preproc: bool = False,
+    max_length: int = 0,
+    limit: int = 0,
+    augmenter: Optional[Callable] = None,
+    shuffle: bool = False,
+) -> Callable:
+    if path is None:
+        raise ValueError("Chemin du corpus manquant")
+    return ShardedCorpus(path, gold_preproc=gold_preproc, max_length=max_length, limit=limit, augmenter=augmenter,
+                         shuffle=shuffle)
@@ -0,0 +1,25 @@
+"""
+Identifiants Dodis : le préfixe de l'URI donne le type d'entité
+(dodis.ch/P… = PER, dodis.ch/G… = LOC, dodis.ch/R… = ORG).
+"""
+import re
+from typing import Optional
+
+ID_PATTERNS = {
+    "PER": re.compile(r"^https?://dodis\.ch/P\d+$"),
+    "LOC": re.compile(r"^https?://dodis\.ch/G\d+$"),
+    "ORG": re.compile(r"^https?://dodis\.ch/R\d+$"),
+}
+ENTITY_TYPES = tuple(ID_PATTERNS)
+# type des identifiants hors Dodis
+UNTYPED = "MISC"
+
+
+def entity_type(uri: str) -> Optional[str]:
+    """
+    PER, LOC ou ORG selon le préfixe de l'identifiant ; None s'il n'est pas un identifiant Dodis
+    """
+    for label, pattern in ID_PATTERNS.items():
+        if pattern.match(uri):
+            return label
+    return None
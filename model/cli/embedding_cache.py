@@ -0,0 +1,189 @@
+"""
+Cache persistant des embeddings de contextes pour build_kb.py.
+
+Les vecteurs sont stockés dans un fichier float32 mappé en mémoire, l'index dans une base SQLite :
+    <cache_dir>/d<dimension>/index.sqlite      clé -> ligne, dernière utilisation
+    <cache_dir>/d<dimension>/vectors-<n>.f32   matrice [capacité, dimension]
+
+La clé est l'empreinte SHA-256 de (encodeur, max_length, texte du contexte) ; pour un vecteur de mention,
+les bornes en caractères de la mention (fenêtre comprise) s'y ajoutent.
+Chaque lot est écrit puis validé aussitôt : une construction interrompue reprend là où elle s'est arrêtée.
+Au-delà de max_entries, les entrées les moins récemment utilisées sont supprimées et le fichier compacté :
+dès l'écriture d'un lot qui dépasserait max_entries + une marge (un huitième), et à la fermeture.
+Le fichier ne dépasse donc jamais cette limite.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+# taille des requêtes SQLite (limite du nombre de paramètres)
+CHUNK = 500
+# marge au-delà de max_entries avant éviction pendant l'écriture (amortit la compaction)
+SLACK = 8
+
+
+class EmbeddingCache:
+
+    def __init__(self, cache_dir: Union[str, Path], dim: int, max_entries: int = 0):
+        self.directory = Path(cache_dir) / f"d{dim}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.max_entries = max_entries
+        # lignes au plus dans le fichier (0 = illimité)
+        self.limit = max_entries + max(max_entries // SLACK, 1) if max_entries else 0
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(str(self.directory / "index.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER, last_used REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+        # lignes écrites mais jamais validées (arrêt brutal) : réutilisées
+        self.n_rows = self.db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM entries").fetchone()[0]
+        self.open_vectors(self.get_meta("file") or "vectors-0.f32")
+
+    @staticmethod
+    def key(encoder: str, max_length: int, text: str, span: Tuple[int, int] = None) -> str:
+        h = hashlib.sha256(f"{encoder}\0{max_length}\0".encode("utf-8"))
+        h.update(text.encode("utf-8"))
+        if span is not None:
+            h.update(f"\0{span[0]}:{span[1]}".encode("utf-8"))
+        return h.hexdigest()
+
+    def get_meta(self, name: str):
+        row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    # --- fichier des vecteurs ---
+
+    def open_vectors(self, name: str, capacity: int = 0):
+        """
+        Ouvre (ou crée) le fichier des vecteurs avec au moins `capacity` lignes
+        """
+        self.file = name
+        path = self.directory / name
+        row_bytes = self.dim * 4
+        size = path.stat().st_size if path.exists() else 0
+        capacity = max(capacity, size // row_bytes, 1024)
+        if size < capacity * row_bytes:
+            with open(path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self.vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def reserve(self, n_rows: int):
+        if n_rows <= self.capacity:
+            return
+        self.vectors.flush()
+        del self.vectors
+        capacity = self.capacity * 2
+        if self.limit:
+            capacity = min(capacity, self.limit)
+        self.open_vectors(self.file, max(n_rows, capacity))
+
+    # --- lecture / écriture ---
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """
+        Vecteurs déjà en cache pour ces clés (les autres sont absentes du résultat)
+        """
+        found = {}
+        now = time.time()
+        for i in range(0, len(keys), CHUNK):
+            chunk = list(keys[i : i + CHUNK])
+            marks = ",".join("?" * len(chunk))
+            rows = self.db.execute(f"SELECT key, row FROM entries WHERE key IN ({marks})", chunk).fetchall()
+            for key, row in rows:
+                found[key] = np.array(self.vectors[row])
+            self.db.execute(f"UPDATE entries SET last_used = ? WHERE key IN ({marks})", [now] + chunk)
+        self.db.commit()
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, keys: Sequence[str], vectors: np.ndarray):
+        """
+        Ajoute un lot : vecteurs écrits sur disque puis index validé
+        """
+        existing = {k for k, in self.db.execute(
+            f"SELECT key FROM entries WHERE key IN ({','.join('?' * len(keys))})", list(keys))} if keys else set()
+        new = []
+        for key, vec in zip(keys, vectors):
+            if key in existing:
+                continue
+            existing.add(key)
+            new.append((key, vec))
+        if not new:
+            return
+        if self.limit:
+            new = new[-self.max_entries:]
+            if self.n_rows + len(new) > self.limit:
+                # place pour le lot : il sera le plus récemment utilisé
+                self.evict(self.max_entries - len(new))
+        self.reserve(self.n_rows + len(new))
+        now = time.time()
+        entries = []
+        for key, vec in new:
+            self.vectors[self.n_rows] = vec
+            entries.append((key, self.n_rows, now))
+            self.n_rows += 1
+        self.vectors.flush()
+        self.db.executemany("INSERT INTO entries (key, row, last_used) VALUES (?, ?, ?)", entries)
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    # --- éviction ---
+
+    def evict(self, keep: int = None) -> int:
+        """
+        Garde les `keep` (par défaut max_entries) entrées les plus récemment utilisées et compacte le fichier.
+        Le nouveau fichier n'est référencé qu'une fois l'index validé : un arrêt laisse le cache cohérent.
+        """
+        keep = self.max_entries if keep is None else keep
+        if not self.max_entries or (len(self) <= keep and self.n_rows <= keep):
+            return 0
+        kept: List[tuple] = self.db.execute(
+            "SELECT key, row FROM entries ORDER BY last_used DESC, row DESC LIMIT ?", (keep,)).fetchall()
+        kept.sort(key=lambda kr: kr[1])
+        n_removed = len(self) - len(kept)
+        old_file = self.file
+        generation = int(old_file.split("-")[1].split(".")[0]) + 1
+        new_file = f"vectors-{generation}.f32"
+        new_path = self.directory / new_file
+        if new_path.exists():
+            new_path.unlink()
+        new_vectors = np.memmap(new_path, dtype=np.float32, mode="w+", shape=(max(len(kept), 1024), self.dim))
+        for new_row, (_, row) in enumerate(kept):
+            new_vectors[new_row] = self.vectors[row]
+        new_vectors.flush()
+        del new_vectors
+
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE kept (key TEXT PRIMARY KEY, row INTEGER)")
+            self.db.executemany("INSERT INTO kept VALUES (?, ?)", [(k, i) for i, (k, _) in enumerate(kept)])
+            self.db.execute("DELETE FROM entries WHERE key NOT IN (SELECT key FROM kept)")
+            self.db.execute("UPDATE entries SET row = (SELECT row FROM kept WHERE kept.key = entries.key)")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('file', ?)", (new_file,))
+            self.db.execute("DROP TABLE kept")
+        del self.vectors
+        os.remove(self.directory / old_file)
+        self.n_rows = len(kept)
+        self.open_vectors(new_file)
+        return n_removed
+
+    def close(self):
+        self.evict()
+        self.vectors.flush()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
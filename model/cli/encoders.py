@@ -0,0 +1,328 @@
+"""
+Encodeurs de contextes pour build_kb.py : vecteur = moyenne des états cachés du modèle sur les tokens
+(embed_batch), ou sur les seuls wordpieces d'une mention, chaque texte distinct n'étant encodé qu'une fois (embed_spans).
+
+Backends :
+- hf   : modèle Hugging Face PyTorch en fp32 (référence)
+- int8 : même modèle, couches linéaires quantifiées dynamiquement en int8 (torch.quantization.quantize_dynamic)
+- onnx : modèle exporté en ONNX (une fois, dans --onnx-dir) et exécuté avec onnxruntime
+         (dépendances optionnelles : onnx pour l'export, onnxruntime pour l'exécution)
+- pipeline : composant transformer d'un pipeline spaCy entraîné (spacy-transformers), nom = chemin du pipeline ;
+             moyenne des wordpieces de doc._.trf_data alignés sur les tokens du contexte
+
+torch, transformers et onnxruntime ne sont importés qu'à la construction d'un encodeur.
+
+Contrôle de la dérive des backends par rapport au premier (similarité cosinus sur un échantillon de contextes) :
+python cli/encoders.py --texts ./ner_traindata.jsonl --backends hf int8 onnx --sample 256
+"""
+import argparse
+import inspect
+import random
+import re
+import time
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+DEFAULT_ENCODER = "bert-base-german-cased"
+DEFAULT_ONNX_DIR = Path("./onnx_encoders")
+_encoders = {}
+
+
+def set_torch_threads(threads: int):
+    """
+    Fixe le parallélisme intra-op de torch (threads) et désactive le parallélisme inter-op
+    """
+    import torch
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # déjà fixé (ou travail inter-op déjà lancé) dans ce processus
+        pass
+
+
+def mean_pool(hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    mask = mask[..., None].astype(hidden.dtype)
+    return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+
+class HFEncoder:
+    """
+    Modèle Hugging Face PyTorch en fp32
+    """
+    backend = "hf"
+
+    def __init__(self, name: str, **options):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.name = name
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(name)
+        self.model = AutoModel.from_pretrained(name)
+        self.model.eval()
+
+    @property
+    def dim(self) -> int:
+        return self.model.config.hidden_size
+
+    @property
+    def id(self) -> str:
+        """
+        Identifiant de l'encodeur (clé du cache d'embeddings) : le nom du modèle, suffixé du backend hors fp32
+        """
+        return self.name if self.backend == "hf" else f"{self.name}@{self.backend}"
+
+    def token_lengths(self, texts: List[str], max_length: int = 128) -> List[int]:
+        return [len(ids) for ids in self.tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]]
+
+    def embed_batch(self, texts: List[str], max_length: int = 128) -> np.ndarray:
+        with self.torch.no_grad():
+            toks = self.tokenizer(texts, return_tensors="pt", truncation=True, padding=True, max_length=max_length)
+            outs = self.model(**toks).last_hidden_state
+            mask = toks["attention_mask"]
+            summed = (outs * mask.unsqueeze(-1)).sum(dim=1)
+            denom = mask.sum(dim=1, keepdim=True).clamp(min=1e-9)
+            return (summed / denom).cpu().numpy()
+
+    def hidden_states(self, texts: List[str], max_length: int = 128) -> Tuple[np.ndarray, dict]:
+        """
+        États cachés [textes, wordpieces, dimension] et sortie du tokenizer (avec offset_mapping)
+        """
+        toks = self.tokenizer(texts, return_tensors="pt", truncation=True, padding=True, max_length=max_length,
+                              return_offsets_mapping=True)
+        offsets = toks.pop("offset_mapping")
+        with self.torch.no_grad():
+            hidden = self.model(**toks).last_hidden_state.cpu().numpy()
+        return hidden, {"offset_mapping": offsets.numpy(), "attention_mask": toks["attention_mask"].numpy()}
+
+    def embed_spans(self, texts: List[str], spans: List[Tuple[int, int]], max_length: int = 128) -> np.ndarray:
+        """
+        Vecteur de chaque mention (texte, bornes en caractères) : moyenne des wordpieces qui recouvrent ses bornes.
+        Chaque texte distinct passe une seule fois dans le modèle ; une mention coupée par max_length
+        reçoit la moyenne de tout le texte.
+        """
+        unique = list(dict.fromkeys(texts))
+        row_of = {text: i for i, text in enumerate(unique)}
+        hidden, toks = self.hidden_states(unique, max_length)
+        offsets, mask = toks["offset_mapping"], toks["attention_mask"]
+        out = np.empty((len(texts), hidden.shape[-1]), dtype=np.float32)
+        for k, (text, (start, end)) in enumerate(zip(texts, spans)):
+            i = row_of[text]
+            # tokens spéciaux et remplissage : offsets (0, 0)
+            pieces = np.flatnonzero((offsets[i, :, 1] > offsets[i, :, 0]) &
+                                    (offsets[i, :, 0] < end) & (offsets[i, :, 1] > start))
+            if len(pieces):
+                out[k] = hidden[i, pieces].mean(axis=0)
+            else:
+                out[k] = mean_pool(hidden[i : i + 1], mask[i : i + 1])[0]
+        return out
+
+
+class QuantizedHFEncoder(HFEncoder):
+    """
+    Couches linéaires quantifiées en int8 (poids), activations quantifiées à la volée
+    """
+    backend = "int8"
+
+    def __init__(self, name: str, **options):
+        super().__init__(name)
+        self.model = self.torch.quantization.quantize_dynamic(self.model, {self.torch.nn.Linear}, dtype=self.torch.qint8)
+
+
+class OnnxEncoder(HFEncoder):
+    """
+    Modèle exporté en ONNX puis exécuté par onnxruntime ; l'export est fait une fois et réutilisé
+    """
+    backend = "onnx"
+
+    def __init__(self, name: str, onnx_dir: Path = DEFAULT_ONNX_DIR, threads: int = 0, **options):
+        try:
+            import onnxruntime
+        except ImportError as exc:
+            raise ImportError("Le backend 'onnx' nécessite onnxruntime (pip install onnxruntime)") from exc
+        from transformers import AutoConfig, AutoTokenizer
+
+        self.name = name
+        self.tokenizer = AutoTokenizer.from_pretrained(name)
+        self.config = AutoConfig.from_pretrained(name)
+        path = Path(onnx_dir) / (re.sub(r"[^\w.-]+", "_", name.strip("/")) + ".onnx")
+        if not path.exists():
+            self.export(name, path)
+        session_options = onnxruntime.SessionOptions()
+        if threads:
+            session_options.intra_op_num_threads = threads
+            session_options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(str(path), session_options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    @property
+    def dim(self) -> int:
+        return self.config.hidden_size
+
+    @staticmethod
+    def export(name: str, path: Path):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        model = AutoModel.from_pretrained(name)
+        model.eval()
+        model.config.return_dict = False
+        toks = tokenizer(["Der Bundesrat tagt in Bern."], return_tensors="pt")
+        # entrées du graphe dans l'ordre de la signature de forward()
+        names = [n for n in inspect.signature(model.forward).parameters if n in toks]
+        axes = {n: {0: "batch", 1: "sequence"} for n in names}
+        axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        kwargs = dict(input_names=names, output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=14)
+        with torch.no_grad():
+            inputs = ({n: toks[n] for n in names},)
+            try:
+                # exporteur TorchScript (les versions récentes de torch utilisent dynamo par défaut)
+                torch.onnx.export(model, inputs, str(tmp), dynamo=False, **kwargs)
+            except TypeError:
+                torch.onnx.export(model, inputs, str(tmp), **kwargs)
+        tmp.replace(path)
+
+    def embed_batch(self, texts: List[str], max_length: int = 128) -> np.ndarray:
+        toks = self.tokenizer(texts, return_tensors="np", truncation=True, padding=True, max_length=max_length)
+        feed = {n: v.astype(np.int64) for n, v in toks.items() if n in self.input_names}
+        hidden = self.session.run(["last_hidden_state"], feed)[0]
+        return mean_pool(hidden, toks["attention_mask"]).astype(np.float32)
+
+    def hidden_states(self, texts: List[str], max_length: int = 128) -> Tuple[np.ndarray, dict]:
+        toks = self.tokenizer(texts, return_tensors="np", truncation=True, padding=True, max_length=max_length,
+                              return_offsets_mapping=True)
+        feed = {n: v.astype(np.int64) for n, v in toks.items() if n in self.input_names}
+        return self.session.run(["last_hidden_state"], feed)[0], toks
+
+
+class PipelineEncoder:
+    """
+    Transformer d'un pipeline spaCy entraîné : les vecteurs sont ceux que voit l'entity_linker du pipeline.
+    Les autres composants sont désactivés ; build_kb.py passe chaque doc des DocBin une fois dans nlp.pipe
+    et moyenne les wordpieces de chacun de ses contextes (pool)
+    """
+    backend = "pipeline"
+
+    def __init__(self, name: str, component: str = "transformer", **options):
+        import spacy
+        from thinc.api import get_current_ops
+
+        self.name = name
+        self.nlp = spacy.load(name, enable=[component])
+        self.ops = get_current_ops()
+        # un pipeline réentraîné au même chemin ne doit pas relire les vecteurs de l'ancien dans le cache
+        weights = Path(name) / component / "model"
+        self.version = int(weights.stat().st_mtime) if weights.exists() else None
+        self.dim = self.pool(self.nlp("Der Bundesrat tagt in Bern."), [(0, 6)]).shape[1]
+
+    @property
+    def id(self) -> str:
+        return f"{self.name}@{self.backend}" + (f"-{self.version}" if self.version else "")
+
+    def pool(self, doc, spans: Iterable[Tuple[int, int]]) -> np.ndarray:
+        """
+        Moyenne des états cachés des wordpieces alignés sur les tokens [start, end) de chaque span
+        (un wordpiece vu dans deux fenêtres glissantes compte deux fois)
+        """
+        trf = doc._.trf_data
+        hidden = self.ops.to_numpy(trf.model_output.last_hidden_state)
+        hidden = hidden.reshape(-1, hidden.shape[-1])
+        out = []
+        for start, end in spans:
+            rows = self.ops.to_numpy(trf.align[start:end].dataXd).ravel()
+            out.append(hidden[rows].mean(axis=0) if len(rows) else np.zeros(hidden.shape[1], dtype=np.float32))
+        return np.stack(out).astype(np.float32)
+
+    def token_lengths(self, texts: List[str], max_length: int = 128) -> List[int]:
+        return [len(doc) for doc in self.nlp.tokenizer.pipe(texts)]
+
+    def embed_batch(self, texts: List[str], max_length: int = 128) -> np.ndarray:
+        # textes isolés (cosine_drift, embed_contexts) : max_length est fixé par les fenêtres du pipeline
+        return np.concatenate([self.pool(doc, [(0, len(doc))]) for doc in self.nlp.pipe(texts)])
+
+    def embed_spans(self, texts: List[str], spans: List[Tuple[int, int]], max_length: int = 128) -> np.ndarray:
+        unique = list(dict.fromkeys(texts))
+        docs = dict(zip(unique, self.nlp.pipe(unique)))
+        out = []
+        for text, (start, end) in zip(texts, spans):
+            doc = docs[text]
+            span = doc.char_span(start, end, alignment_mode="expand")
+            out.append(self.pool(doc, [(span.start, span.end) if span is not None else (0, len(doc))]))
+        return np.concatenate(out)
+
+
+# backends des modèles Hugging Face ; "pipeline" (nom = chemin d'un pipeline spaCy) n'est accessible que par
+# build_kb.py --embed-source pipeline et par update_kb.py pour une KB construite ainsi
+BACKENDS = {"hf": HFEncoder, "int8": QuantizedHFEncoder, "onnx": OnnxEncoder}
+PIPELINE_BACKEND = "pipeline"
+
+
+def get_encoder(name: str = DEFAULT_ENCODER, backend: str = "hf", **options) -> HFEncoder:
+    """
+    Encodeur chargé à la première demande, puis réutilisé
+    """
+    if (name, backend) not in _encoders:
+        if backend == PIPELINE_BACKEND:
+            _encoders[name, backend] = PipelineEncoder(name, **options)
+        elif backend in BACKENDS:
+            _encoders[name, backend] = BACKENDS[backend](name, **options)
+        else:
+            raise ValueError(f"Backend inconnu : {backend} (choix : {', '.join(BACKENDS)})")
+    return _encoders[name, backend]
+
+
+def load_texts(path: Path) -> List[str]:
+    """
+    Contextes d'un fichier texte (une ligne chacun) ou de données d'entraînement NER (.jsonl/.json)
+    """
+    if path.suffix == ".txt":
+        return [line.strip() for line in path.read_text("utf-8").splitlines() if line.strip()]
+    from traindata_io import iter_train_data
+
+    return [text for text, _ in iter_train_data(path) if text.strip()]
+
+
+def cosine_drift(encoder_name: str, backends: List[str], texts: List[str], batch_size: int = 32,
+                 max_length: int = 128, onnx_dir: Path = DEFAULT_ONNX_DIR):
+    """
+    Encode les textes avec chaque backend et compare au premier (similarité cosinus par texte)
+    """
+    reference = None
+    print(f"{'backend':>8} {'ctx/s':>8} {'cos moyen':>10} {'cos min':>8} {'cos p1':>8}")
+    for backend in backends:
+        encoder = get_encoder(encoder_name, backend, onnx_dir=onnx_dir)
+        start = time.perf_counter()
+        vectors = np.concatenate([encoder.embed_batch(texts[i : i + batch_size], max_length)
+                                  for i in range(0, len(texts), batch_size)])
+        speed = len(texts) / (time.perf_counter() - start)
+        if reference is None:
+            reference = vectors
+        cos = (vectors * reference).sum(axis=1) / (
+            np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1) + 1e-12)
+        print(f"{backend:>8} {speed:>8.1f} {cos.mean():>10.5f} {cos.min():>8.5f} {np.percentile(cos, 1):>8.5f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dérive cosinus des backends d'encodage sur un échantillon de contextes")
+    parser.add_argument("--texts", required=True, help="Contextes : .txt (une ligne chacun) ou données NER .jsonl/.json")
+    parser.add_argument("--encoder", default=DEFAULT_ENCODER)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS),
+                        help="Backends comparés, le premier sert de référence")
+    parser.add_argument("--sample", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--onnx-dir", default=str(DEFAULT_ONNX_DIR))
+    args = parser.parse_args()
+
+    texts = load_texts(Path(args.texts))
+    if len(texts) > args.sample:
+        texts = random.Random(args.seed).sample(texts, args.sample)
+    cosine_drift(args.encoder, args.backends, texts, args.batch_size, args.max_length, Path(args.onnx_dir))
@@ -0,0 +1,54 @@
+"""
+Cache persistant des extractions HTML, indexé par l'empreinte SHA-256 du contenu des fichiers.
+
+Un document inchangé est relu depuis le cache ; seuls les fichiers nouveaux ou modifiés sont analysés.
+Chaque extraction utilise son propre espace de noms (à changer lorsque la logique d'extraction évolue) :
+    <cache_dir>/<namespace>/<2 premiers caractères>/<empreinte>.json
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Union
+
+
+class ExtractionCache:
+
+    def __init__(self, cache_dir: Union[str, Path]):
+        self.directory = Path(cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(data: bytes, namespace: str) -> str:
+        h = hashlib.sha256(namespace.encode("utf-8") + b"\0")
+        h.update(data)
+        return h.hexdigest()
+
+    def entry_path(self, key: str, namespace: str) -> Path:
+        return self.directory / namespace / key[:2] / (key + ".json")
+
+    def get_or_compute(self, path: Union[str, Path], compute: Callable[[str], Any], namespace: str) -> Any:
+        """
+        Résultat de compute(texte du fichier), relu depuis le cache si le contenu n'a pas changé.
+        Le résultat doit être sérialisable en JSON (les tuples sont relus comme des listes).
+        """
+        path = Path(path)
+        key = self.digest(path.read_bytes(), namespace)
+        entry = self.entry_path(key, namespace)
+        if entry.exists():
+            try:
+                result = json.loads(entry.read_text("utf-8"))
+                self.hits += 1
+                return result
+            except ValueError:
+                # entrée corrompue (écriture interrompue) : on recalcule
+                pass
+        result = compute(path.read_text(encoding="utf-8"))
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # écriture atomique, sûre avec plusieurs processus
+        tmp = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(result, ensure_ascii=False), "utf-8")
+        os.replace(tmp, entry)
+        self.misses += 1
+        return result
@@ -0,0 +1,289 @@
+"""
+Extraction des blocs de texte d'un document HTML Dodis : titre principal, sous-titre puis paragraphes,
+sans les notes de bas de page, avec les ancres (<a>) qu'ils contiennent.
+
+Partagé par model/cli/ner_create.py et les scripts d'analyse des chapitres 4 et 5.
+
+extract_blocks lit le document en une passe (événements html.parser, sans construire d'arbre) et reproduit
+à l'identique le résultat de BeautifulSoup(text, 'html.parser') + select/extract des notes + get_text().strip(),
+conservé dans extract_blocks_soup comme référence.
+
+Vérification sur un dossier :
+python cli/html_extract.py ../raw_data
+"""
+import re
+import sys
+from html.entities import html5
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import List
+
+NOTE_CLASSES = {"tei-note", "tei-note2", "tei-note3", "tei-note4"}
+NOTE_SELECTOR = '.tei-note, .tei-note2, .tei-note3, .tei-note4'
+# espace de noms de extract_blocks dans extraction_cache.ExtractionCache
+CACHE_NAMESPACE = "html_blocks-v1"
+
+# comportement du constructeur d'arbre 'html.parser' de BeautifulSoup
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta",
+                 "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame", "image", "isindex",
+                 "nextid", "spacer"}
+# éléments dont le texte n'est pas rendu par get_text() (Script, Stylesheet, TemplateString, Ruby*)
+STRING_CONTAINERS = {"rt", "rp", "style", "script", "template"}
+PRESERVE_WHITESPACE = {"pre", "textarea"}
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+_nonwhitespace_re = re.compile(r"\S+")
+
+
+def _entity_table() -> dict:
+    """
+    Entités nommées (sans point-virgule) -> caractères, comme bs4.dammit.EntitySubstitution
+    """
+    table = {}
+    for name, character in sorted(html5.items()):
+        table.setdefault(name[:-1] if name.endswith(";") else name, character)
+    return table
+
+
+ENTITIES = _entity_table()
+
+
+class _Element:
+    __slots__ = ("name", "block", "anchor", "note", "container", "preserve")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.block = None
+        self.anchor = None
+        self.note = False
+        self.container = False
+        self.preserve = False
+
+
+class BlockExtractor(HTMLParser):
+    """
+    Parcours événementiel du document : le texte de chaque bloc et de chaque ancre ouverts est accumulé
+    au fil de la lecture, sauf à l'intérieur d'une note descendante (les notes sont ignorées sans être construites).
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+        self.open_counts = {}
+        self.note_levels = []
+        self.already_closed = []
+        self.current_data = []
+        self.title = None
+        self.sub = None
+        self.paragraphs = []
+
+    # --- pile des éléments ouverts ---
+
+    def push(self, name: str, attrs: dict):
+        element = _Element(name)
+        classes = _nonwhitespace_re.findall(attrs.get("class", ""))
+        level = len(self.stack)
+        element.note = not NOTE_CLASSES.isdisjoint(classes)
+        element.container = name in STRING_CONTAINERS
+        element.preserve = name in PRESERVE_WHITESPACE
+        if element.note:
+            self.note_levels.append(level)
+        if name == "a":
+            anchor = {"text": [], "classes": classes, "href": attrs.get("href")}
+            element.anchor = anchor
+            # l'ancre appartient aux blocs ouverts dont elle n'est pas séparée par une note
+            last_note = self.note_levels[-1] if self.note_levels else -1
+            for i, parent in enumerate(self.stack):
+                if parent.block is not None and i >= last_note:
+                    parent.block["anchors"].append(anchor)
+        block = None
+        if name == "p":
+            block = self.new_block()
+            self.paragraphs.append(block)
+        elif name == "div" and self.title is None and "tei-title-main" in classes:
+            block = self.title = self.new_block()
+        elif name == "h1" and self.sub is None and "tei-title-sub" in classes:
+            block = self.sub = self.new_block()
+        element.block = block
+        self.stack.append(element)
+        self.open_counts[name] = self.open_counts.get(name, 0) + 1
+
+    @staticmethod
+    def new_block() -> dict:
+        return {"text": [], "anchors": []}
+
+    def pop(self):
+        element = self.stack.pop()
+        self.open_counts[element.name] -= 1
+        if self.note_levels and self.note_levels[-1] == len(self.stack):
+            self.note_levels.pop()
+
+    def pop_to(self, name: str):
+        # comme BeautifulSoup._popToTag : jusqu'au plus récent élément de ce nom, s'il y en a un d'ouvert
+        while self.stack and self.open_counts.get(name):
+            element = self.stack[-1]
+            self.pop()
+            if element.name == name:
+                break
+
+    # --- texte ---
+
+    def end_data(self, text: bool = True):
+        """
+        Termine le segment de texte en cours et le distribue aux blocs et ancres ouverts
+        """
+        if not self.current_data:
+            return
+        data = "".join(self.current_data)
+        self.current_data = []
+        if not any(element.preserve for element in self.stack):
+            if all(c in ASCII_SPACES for c in data):
+                data = "\n" if "\n" in data else " "
+        if not text:
+            return
+        last_note = self.note_levels[-1] if self.note_levels else -1
+        for i in range(max(last_note, 0), len(self.stack)):
+            element = self.stack[i]
+            if element.block is not None:
+                element.block["text"].append(data)
+            if element.anchor is not None:
+                element.anchor["text"].append(data)
+
+    def in_container(self) -> bool:
+        return any(element.container for element in self.stack)
+
+    # --- événements html.parser ---
+
+    def handle_starttag(self, name, attrs, handle_empty_element=True):
+        attr_dict = {}
+        for key, value in attrs:
+            attr_dict[key] = "" if value is None else value
+        self.end_data(not self.in_container())
+        self.push(name, attr_dict)
+        if name in VOID_ELEMENTS and handle_empty_element:
+            self.handle_endtag(name, check_already_closed=False)
+            self.already_closed.append(name)
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, handle_empty_element=False)
+        self.handle_endtag(name)
+
+    def handle_endtag(self, name, check_already_closed=True):
+        if check_already_closed and name in self.already_closed:
+            self.already_closed.remove(name)
+        else:
+            self.end_data(not self.in_container())
+            self.pop_to(name)
+
+    def handle_data(self, data):
+        self.current_data.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith(("x", "X")):
+            code = int(name.lstrip("xX"), 16)
+        else:
+            code = int(name)
+        data = None
+        if code < 256:
+            try:
+                data = bytearray([code]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(code)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_entityref(self, name):
+        character = ENTITIES.get(name)
+        self.handle_data(character if character is not None else "&%s" % name)
+
+    def handle_special(self, data: str, text: bool):
+        self.end_data(not self.in_container())
+        self.handle_data(data)
+        self.end_data(text)
+
+    def handle_comment(self, data):
+        self.handle_special(data, False)
+
+    def handle_decl(self, data):
+        self.handle_special(data[len("DOCTYPE "):], False)
+
+    def unknown_decl(self, data):
+        # les sections CDATA sont du texte pour get_text(), les autres déclarations non
+        if data.upper().startswith("CDATA["):
+            self.handle_special(data[len("CDATA["):], True)
+        else:
+            self.handle_special(data, False)
+
+    def handle_pi(self, data):
+        self.handle_special(data, False)
+
+    def blocks(self) -> List[dict]:
+        """
+        Blocs dans l'ordre de l'extraction : titre, sous-titre puis paragraphes
+        """
+        ordered = [b for b in (self.title, self.sub) if b is not None] + self.paragraphs
+        return [
+            {
+                "text": "".join(block["text"]).strip(),
+                "anchors": [["".join(a["text"]).strip(), a["classes"], a["href"]] for a in block["anchors"]],
+            }
+            for block in ordered
+        ]
+
+
+def extract_blocks(text: str, separate_links: bool = False) -> List[dict]:
+    """
+    Retourne pour chaque bloc {"text": texte sans les notes, "anchors": [[texte, classes, href], ...]}
+
+    separate_links : insère un espace entre deux liens consécutifs (évite la concaténation des textes des <a>)
+    """
+    if separate_links:
+        text = re.sub(r'(</a>)(<a\b)', r'\1 \2', text)
+    parser = BlockExtractor()
+    parser.feed(text)
+    parser.close()
+    parser.end_data(not parser.in_container())
+    return parser.blocks()
+
+
+def extract_blocks_soup(text: str, separate_links: bool = False) -> List[dict]:
+    """
+    Implémentation de référence avec BeautifulSoup (arbre complet), même format que extract_blocks
+    """
+    from bs4 import BeautifulSoup
+
+    if separate_links:
+        text = re.sub(r'(</a>)(<a\b)', r'\1 \2', text)
+    soup = BeautifulSoup(text, 'html.parser')
+    paragraphs = []
+    title = soup.find('div', {"class": 'tei-title-main'})
+    if title is not None:
+        paragraphs.append(title)
+    sub = soup.find('h1', {"class": 'tei-title-sub'})
+    if sub is not None:
+        paragraphs.append(sub)
+    paragraphs.extend(soup.find_all('p'))
+
+    blocks = []
+    for p in paragraphs:
+        # suppression des notes du paragraphe
+        [note.extract() for note in p.select(NOTE_SELECTOR)]
+        anchors = [[a.get_text().strip(), a.get("class") or [], a.get("href")] for a in p.find_all('a')]
+        blocks.append({"text": p.get_text().strip(), "anchors": anchors})
+    return blocks
+
+
+if __name__ == "__main__":
+    # compare les deux implémentations sur tous les fichiers HTML d'un dossier
+    differences = 0
+    files = sorted(Path(sys.argv[1]).glob("*.html"))
+    for file in files:
+        text = file.read_text(encoding="utf-8")
+        for separate_links in (False, True):
+            if extract_blocks(text, separate_links) != extract_blocks_soup(text, separate_links):
+                differences += 1
+                print(f"Différence : {file.name} (separate_links={separate_links})")
+    print(f"{len(files)} fichiers comparés, {differences} différence(s)")
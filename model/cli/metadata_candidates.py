@@ -0,0 +1,143 @@
+"""
+Listes blanches de candidats par document, tirées des métadonnées Dodis (raw_data/<id>.json) :
+relPersons, relOrganizations et relPlaces (rôle -> [{"id": ...}, ...]) donnent les entités liées au document
+(https://dodis.ch/P…, R…, G…).
+
+À l'inférence, le document est identifié par l'extension doc._.dodis_id (nom du fichier sans extension) :
+    doc = nlp.make_doc(text)
+    doc._.dodis_id = "42001"
+    doc = nlp(doc)
+Parmi les candidats de l'index d'alias (alias_index.py), seuls ceux cités par les métadonnées sont gardés ;
+si aucun ne l'est, tous les candidats de la KB sont rendus (avec strict : aucun). Sans dodis_id ou sans
+métadonnées pour le document, les candidats ne sont pas filtrés.
+Un seul candidat restant est retenu par l'entity_linker sans calcul de score.
+Les métadonnées sont lues une fois par document distinct d'un lot de mentions et gardées en cache (LRU).
+
+Dans config.cfg (avec --code cli/metadata_candidates.py) :
+[components.entity_linker.get_candidates_batch]
+@misc = "dodis.WhitelistCandidatesBatch.v1"
+index_path = "../kb/alias_index"
+meta_dir = "../raw_data"
+
+Couverture des listes blanches par la KB :
+python cli/metadata_candidates.py --meta ../raw_data --kb ./kb_exported
+"""
+import json
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+import spacy
+from spacy.kb import Candidate, KnowledgeBase
+from spacy.tokens import Doc, Span
+
+from alias_index import TrieCandidates
+from dodis_ids import entity_type
+
+RELATION_FIELDS = {"relPersons": "P", "relOrganizations": "R", "relPlaces": "G"}
+
+if not Doc.has_extension("dodis_id"):
+    Doc.set_extension("dodis_id", default=None)
+
+
+def load_relations(path: Union[str, Path]) -> FrozenSet[str]:
+    """
+    URI des personnes, organisations et lieux liés au document (tous rôles confondus)
+    """
+    data = json.loads(Path(path).read_text("utf-8"))
+    data = data.get("data", data)
+    uris = set()
+    for field, prefix in RELATION_FIELDS.items():
+        relations = data.get(field) or {}
+        groups = relations.values() if isinstance(relations, dict) else [relations]
+        for items in groups:
+            for item in items or []:
+                if isinstance(item, dict) and str(item.get("id", "")).strip():
+                    uris.add(f"https://dodis.ch/{prefix}{str(item['id']).strip()}")
+    return frozenset(uris)
+
+
+class MetadataWhitelists:
+    """
+    Lignes de l'index d'alias des entités liées à chaque document, lues à la demande et gardées en cache
+    """
+
+    def __init__(self, meta_dir: Union[str, Path], row_of: Dict[str, int], cache_size: int = 1024):
+        self.meta_dir = Path(meta_dir)
+        self.row_of = row_of
+        self.get = lru_cache(maxsize=cache_size)(self.load)
+
+    def load(self, doc_id: str) -> FrozenSet[int]:
+        path = self.meta_dir / f"{doc_id}.json"
+        if not path.exists():
+            return frozenset()
+        return frozenset(self.row_of[uri] for uri in load_relations(path) if uri in self.row_of)
+
+    def get_many(self, doc_ids: Iterable[Optional[str]]) -> List[FrozenSet[int]]:
+        """
+        Une lecture par document distinct du lot
+        """
+        doc_ids = list(doc_ids)
+        found = {doc_id: self.get(str(doc_id)) for doc_id in set(doc_ids) if doc_id is not None}
+        return [found.get(doc_id, frozenset()) for doc_id in doc_ids]
+
+
+class WhitelistCandidates(TrieCandidates):
+    """
+    Candidats de l'index d'alias restreints aux entités des métadonnées du document.
+    strict : pas de repli sur la KB entière (mention sans candidat lié -> aucun candidat)
+    """
+
+    def __init__(self, index_path: Union[str, Path], meta_dir: Union[str, Path], typed: bool = True,
+                 strict: bool = False, cache_size: int = 1024):
+        super().__init__(index_path, typed)
+        row_of = {eid: row for row, eid in enumerate(self.index.entities)}
+        self.whitelists = MetadataWhitelists(meta_dir, row_of, cache_size)
+        self.strict = strict
+
+    def restrict(self, records: List[Tuple[int, float]], whitelist: FrozenSet[int]) -> List[Tuple[int, float]]:
+        kept = [(row, prior) for row, prior in records if row in whitelist]
+        return kept if kept or self.strict else records
+
+    def batch(self, kb: KnowledgeBase, mentions: Iterable[Span]) -> List[List[Candidate]]:
+        mentions = list(mentions)
+        records = self.index.lookup_batch([m.text for m in mentions], self.labels(mentions))
+        whitelists = self.whitelists.get_many(m.doc._.dodis_id for m in mentions)
+        records = [self.restrict(recs, wl) if wl else recs for recs, wl in zip(records, whitelists)]
+        return self.make_candidates(kb, mentions, records)
+
+
+@spacy.registry.misc("dodis.WhitelistCandidates.v1")
+def create_whitelist_candidates(
+    index_path: Path, meta_dir: Path, typed: bool = True, strict: bool = False, cache_size: int = 1024
+) -> Callable[[KnowledgeBase, Span], List[Candidate]]:
+    return WhitelistCandidates(index_path, meta_dir, typed, strict, cache_size)
+
+
+@spacy.registry.misc("dodis.WhitelistCandidatesBatch.v1")
+def create_whitelist_candidates_batch(
+    index_path: Path, meta_dir: Path, typed: bool = True, strict: bool = False, cache_size: int = 1024
+) -> Callable[[KnowledgeBase, Iterable[Span]], List[List[Candidate]]]:
+    return WhitelistCandidates(index_path, meta_dir, typed, strict, cache_size).batch
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Couverture par la KB des entités liées dans les métadonnées")
+    parser.add_argument("--meta", required=True, help="Dossier des métadonnées JSON (raw_data)")
+    parser.add_argument("--kb", required=True, help="Dossier de sortie de build_kb.py (alias_index)")
+    args = parser.parse_args()
+
+    from alias_index import AliasIndex
+
+    entities = set(AliasIndex.from_disk(Path(args.kb) / "alias_index").entities)
+    linked, in_kb = Counter(), Counter()
+    files = sorted(Path(args.meta).glob("*.json"))
+    for path in files:
+        for uri in load_relations(path):
+            linked[entity_type(uri)] += 1
+            in_kb[entity_type(uri)] += uri in entities
+    print(f"{len(files)} documents")
+    for etype in sorted(linked):
+        print(f"  {etype}: {linked[etype]} relations, {in_kb[etype]} dans la KB ({in_kb[etype] / linked[etype]:.1%})")
@@ -2,14 +2,25 @@ import json
 import os
 import random
 import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import Optional
 
-import bs4.element
 import typer
-from bs4 import BeautifulSoup
 import spacy
 from spacy.tokens import DocBin
 
+from alias_matcher import AliasMatcher
+from docbin_shards import ShardedDocBinWriter
+from extraction_cache import ExtractionCache
+from html_extract import extract_blocks
+from traindata_io import TrainDataWriter
+
+# espace de noms du cache d'extraction (à changer si prepare_blocks évolue)
+CACHE_NAMESPACE = "ner_create.prepare-v1"
+
 
 def prepare_links(text: str) -> str:
     return text.replace("http://", "https://")
@@ -24,39 +35,66 @@ def load(path: str):
     return text
 
 
+def prepare_blocks(text: str) -> list:
+    """
+    Extrait les blocs du document avec leurs ancres TEI et les positions des entités
+    Format mis en cache : [{"text": ..., "anchors": [...], "entities": [[start, end, label, dodis_id], ...]}, ...]
+    """
+    # Prétraitement : insérer un espace entre deux liens consécutifs,
+    # afin d'éviter la concaténation des textes des balises <a>
+    blocks = extract_blocks(text, separate_links=True)
+    for block in blocks:
+        entity = Entity()
+        entity.find(block["text"], block["anchors"])
+        block["entities"] = entity.get_entities()
+    return blocks
+
+
 def prepare(text: str) -> list:
     """
     Prepare training data pour ner
     Marque les entités avec START:position et END:position et label tei
     """
-    # Prétraitement : insérer un espace entre deux liens consécutifs,
-    # afin d'éviter la concaténation des textes des balises <a>
-    text = re.sub(r'(</a>)(<a\b)', r'\1 \2', text)
-    paragraphs = []
-    soup = BeautifulSoup(text, 'html.parser')
-    title = soup.find('div', {"class": 'tei-title-main'})
-    if title is not None:
-        paragraphs.append(title)
-    sub = soup.find('h1', {"class": 'tei-title-sub'})
-    if sub is not None:
-        paragraphs.append(sub)
-    for p in soup.find_all('p'):
-        paragraphs.append(p)
     # format : [texte, [[start, end, label, dodis_id], ...]]
-    entities = []
-    for p in paragraphs:
-        if p is None:
-            continue
-        entity = Entity()
+    return [[block["text"], block["entities"]] for block in prepare_blocks(text)]
 
-        # suppression des notes du paragraphe
-        [note.extract() for note in p.select('.tei-note4, .tei-note2, .tei-note3, .tei-note')]
-        # extraction des entités
-        content = p.get_text().strip()
-        entity.find(content, p)
-        entities.append([content, entity.get_entities()])
 
-    return entities
+def prepare_file(path: str, cache_dir: Optional[Path] = None) -> list:
+    """
+    Charge et prépare un fichier HTML (point d'entrée des workers du pool)
+    Avec cache_dir, les documents inchangés sont relus depuis le cache d'extraction
+    """
+    if cache_dir is None:
+        return prepare(load(path))
+    blocks = ExtractionCache(cache_dir).get_or_compute(path, prepare_blocks, CACHE_NAMESPACE)
+    return [[block["text"], block["entities"]] for block in blocks]
+
+
+def prepare_all(path: Path, workers: int = 1, writer: Optional[TrainDataWriter] = None,
+                cache_dir: Optional[Path] = None) -> list:
+    """
+    Prépare tous les fichiers HTML du dossier, en série ou via un pool de processus.
+    Les fichiers sont triés par nom et les résultats conservent cet ordre (split reproductible).
+    Si un writer est fourni, les entrées y sont écrites au fur et à mesure.
+    """
+    prepare_one = partial(prepare_file, cache_dir=cache_dir)
+    files = [os.path.join(path, entry) for entry in sorted(os.listdir(path)) if entry.endswith(".html")]
+    train_data = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map() restitue les résultats dans l'ordre des fichiers
+            results = executor.map(prepare_one, files, chunksize=4)
+            for entities in results:
+                train_data.extend(entities)
+                if writer is not None:
+                    writer.write_all(entities)
+    else:
+        for file in files:
+            entities = prepare_one(file)
+            train_data.extend(entities)
+            if writer is not None:
+                writer.write_all(entities)
+    return train_data
 
 
 def trans_class_name(class_name: str) -> str:
@@ -80,37 +118,22 @@ class Entity:
         self.content = ""
         self.class_names = ["tei-persName", "tei-placeName", "tei-orgName"]
 
-    def find(self, content: str, tag: bs4.element.Tag):
+    def find(self, content: str, anchors: list):
         """
         Recherche toutes les entités TEI dans le HTML.
+        anchors : ancres du bloc [[texte, classes, href], ...] (cf. html_extract.extract_blocks)
         """
         self.content = content
-        matches = tag.findAll('a')
-        if matches is None:
-            return
 
         # pour éviter des chevauchements (ex. PLO et PLO-Büro) ???
         raw = []
-        for m in matches:
-            if m.get("class") is not None and m.get("class")[0] in self.class_names:
-                raw.append((m.get_text().strip(), trans_class_name(m.get("class")[0]), prepare_links(m.get("href"))))
-
-        # suppression des doublons et tri par longueur du plus grand au plus petit
-        raw = list(set(raw))
-        raw = sorted(raw, reverse=True, key=lambda x: len(x[0]))
-
-        for m, label, dodis_id in raw:
-            pattern = r'(%s)' % re.escape(m)
-            indexes = re.finditer(pattern, content, flags=re.IGNORECASE) # <--- ajout pour prise en charge des minuscules
-            for match in indexes:
-                # si un span couvrant déjà cette zone existe, on passe
-                found = False
-                for ent in self.entities:
-                    if ent[0] <= match.start() and ent[1] >= match.end():
-                        found = True
-                        break
-                if not found:
-                    self.entities.append((match.start(), match.end(), label, dodis_id))
+        for text, classes, href in anchors:
+            if classes and classes[0] in self.class_names:
+                raw.append((text, trans_class_name(classes[0]), prepare_links(href)))
+
+        # recherche de tous les alias en une passe, du plus long au plus court
+        for start, end, m, (label, dodis_id) in AliasMatcher((m, (label, dodis_id)) for m, label, dodis_id in raw).find(content):
+            self.entities.append((start, end, label, dodis_id))
 
     def get_entities(self):
         """
@@ -119,47 +142,50 @@ class Entity:
         return [t for t in self.entities if t]
 
 
-def save_train_data(train_data: list, path: str):
+def build_traindata(path: Path, target_path: Path, workers: int = 1, seed: Optional[int] = None,
+                    overlap_log: Optional[Path] = None, batch_size: int = 64, n_process: int = 1,
+                    tokenizer_only: bool = False, shard_size: int = 0, compress: bool = False,
+                    cache_dir: Optional[Path] = None):
     """
-    Sauvegarde les données d'entraînement
-    """
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(train_data, f)
-
-
-def build_traindata(path: Path, target_path: Path):
-    """
-    Construit les données d'entraînement (train + dev) pour la NER et les sauvegarde au format JSON
+    Construit les données d'entraînement (train + dev) pour la NER et les sauvegarde au format JSONL
+
+    --workers N : préparation des fichiers HTML en parallèle sur N processus
+    --seed : graine du mélange pour reproduire la répartition train/dev
+    --overlap-log : fichier JSONL des décisions de remove_overlapping (split, concat, overlap)
+    --batch-size / --n-process : traitement des paragraphes par lots via nlp.pipe
+    --tokenizer-only : tokenizer allemand seul (+ sentencizer), sans charger le transformer
+    --shard-size N : écriture en continu dans ner_traindata/ et ner_devdata/ par fragments de N docs
+    --compress : ner_traindata.jsonl.gz au lieu de ner_traindata.jsonl
+    --cache-dir : cache d'extraction par empreinte du contenu (seuls les fichiers nouveaux ou modifiés sont analysés)
     """
     train_data = []
-    try:
-        entries = os.listdir(path)
-        for entry in entries:
-            if entry.endswith(".html"):
-                data = load(os.path.join(path, entry))
-                train_data.extend(prepare(data))
-    except FileNotFoundError:
-        print(f"Le dossier {path} existe pas.")
-    # sauvegarde du format texte déprécié de spacy
-    save_train_data(train_data, (target_path / "ner_traindata.json").as_posix())
+    # sauvegarde du format texte déprécié de spacy, une entrée par ligne au fil de la préparation
+    traindata_name = "ner_traindata.jsonl.gz" if compress else "ner_traindata.jsonl"
+    with TrainDataWriter(target_path / traindata_name) as writer:
+        try:
+            train_data = prepare_all(path, workers, writer, cache_dir)
+        except FileNotFoundError:
+            print(f"Le dossier {path} existe pas.")
 
     # Chargement du modèle spaCy (remarque : on pourrait utiliser notre propre modèle word2vec) ???
-    nlp = spacy.load("de_dep_news_trf")
-    customize_tokenizer(nlp)
-    train_db = DocBin()
-    dev_db = DocBin()
-    random.shuffle(train_data)
+    nlp = load_nlp(tokenizer_only)
+    if shard_size > 0:
+        train_db = ShardedDocBinWriter(target_path / "ner_traindata", shard_size)
+        dev_db = ShardedDocBinWriter(target_path / "ner_devdata", shard_size)
+    else:
+        train_db = DocBin()
+        dev_db = DocBin()
+    random.Random(seed).shuffle(train_data)
     # répartition train/dev (70% train)
     threshold = len(train_data) * 0.7
     counter = 0
+    overlap_records = []
 
-    for text, annotations in train_data:
-        if text is None or is_blank(text):
-            continue
-        doc = nlp(text)
+    # les annotations accompagnent chaque texte dans nlp.pipe (as_tuples)
+    examples = ((text, annotations) for text, annotations in train_data
+                if not (text is None or is_blank(text)) and annotations is not None)
+    for doc, annotations in nlp.pipe(examples, as_tuples=True, batch_size=batch_size, n_process=n_process):
         ents = []
-        if annotations is None:
-            continue
         for start, end, label, dodis_id in annotations:
             # création du span avec alignment_mode="expand"
             span = doc.char_span(start, end, label=label, kb_id=dodis_id, alignment_mode="expand")
@@ -169,7 +195,10 @@ def build_traindata(path: Path, target_path: Path):
             ents.append(span)
 
         try:
-            doc.ents = remove_overlapping(ents)
+            log = [] if overlap_log is not None else None
+            doc.ents = remove_overlapping(ents, log)
+            if log:
+                overlap_records.extend({"doc": counter, **record} for record in log)
             if counter < threshold:
                 train_db.add(doc)
             else:
@@ -180,8 +209,16 @@ def build_traindata(path: Path, target_path: Path):
             for ent in ents:
                 print(ent.text, ent.label_, ent.start, ent.end)
         counter += 1
-    train_db.to_disk((target_path / "ner_traindata.spacy").as_posix())
-    dev_db.to_disk((target_path / "ner_devdata.spacy").as_posix())
+    if shard_size > 0:
+        train_db.close()
+        dev_db.close()
+    else:
+        train_db.to_disk((target_path / "ner_traindata.spacy").as_posix())
+        dev_db.to_disk((target_path / "ner_devdata.spacy").as_posix())
+    if overlap_log is not None:
+        with open(overlap_log, "w", encoding="utf-8") as f:
+            for record in overlap_records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
 
 def is_blank(string: str):
@@ -191,35 +228,41 @@ def is_blank(string: str):
     return not (string and string.strip())
 
 
-def remove_overlapping(ents: list) -> list:
+def log_event(log: Optional[list], event: str, **fields):
+    """
+    Ajoute un diagnostic structuré au journal, s'il y en a un
+    """
+    if log is not None:
+        log.append({"event": event, **fields})
+
+
+def remove_overlapping(ents: list, log: Optional[list] = None) -> list:
     """
     Supprime les entités qui se chevauchent et corrige les cas d'espaces manquants:
     
     Pour chaque span, si manque d'espace entre maj et min, on "split" via regex.
     Si un span apparaît en tant que concaténation de deux spans contigus issus d'un split
     Si chevauchement, on conserve le span couvrant le plus grand nombre de caractères.
+
+    Les décisions sont consignées dans `log` (liste de dict) si fourni.
     """
-    import re
     missing_space_pattern = r'(?<=[a-z])(?=[A-Z])'
     new_ents = []
     for ent in ents:
-        if re.search(missing_space_pattern, ent.text):
-            parts = re.split(missing_space_pattern, ent.text)
-            if len(parts) > 1:
-                print(f"Correction des entités splités '{ent.text}' dans {parts}")
-                offset = ent.start_char
-                for part in parts:
-                    if not part:
-                        continue
-                    new_end = offset + len(part)
-                    new_span = ent.doc.char_span(offset, new_end, label=ent.label_, kb_id=ent.kb_id, alignment_mode="expand")
-                    if new_span is None:
-                        print(f"Impossible de créer un span pour '{part}' (Position {offset}-{new_end})")
-                    else:
-                        new_ents.append(new_span)
-                    offset = new_end
-            else:
-                new_ents.append(ent)
+        parts = re.split(missing_space_pattern, ent.text)
+        if len(parts) > 1:
+            log_event(log, "split", text=ent.text, parts=parts)
+            offset = ent.start_char
+            for part in parts:
+                if not part:
+                    continue
+                new_end = offset + len(part)
+                new_span = ent.doc.char_span(offset, new_end, label=ent.label_, kb_id=ent.kb_id, alignment_mode="expand")
+                if new_span is None:
+                    log_event(log, "split_failed", text=part, start=offset, end=new_end)
+                else:
+                    new_ents.append(new_span)
+                offset = new_end
         else:
             new_ents.append(ent)
     # Suppression des doublons (cf.(start, end, label))
@@ -229,41 +272,64 @@ def remove_overlapping(ents: list) -> list:
         dedup[key] = span
     candidates = list(dedup.values())
 
-    # Suppression des spans qui sont collés
+    # Suppression des spans qui sont collés : index par début et par (start_char, end_char)
+    by_start = defaultdict(list)
+    by_bounds = defaultdict(list)
+    for span in candidates:
+        by_start[span.start_char].append(span)
+        by_bounds[(span.start_char, span.end_char)].append(span)
     to_remove = set()
     for span in candidates:
-        for s1 in candidates:
-            for s2 in candidates:
-                if s1 is not span and s2 is not span and s1 is not s2:
-                    if s1.start_char == span.start_char and s2.end_char == span.end_char and s1.end_char == s2.start_char:
-                        if (s1.text + s2.text).replace(" ", "") == span.text.replace(" ", ""):
-                            print(f" supression de span concat '{span.text}' pour avoir des spans splités '{s1.text}' and '{s2.text}'.")
-                            to_remove.add(span)
+        for s1 in by_start[span.start_char]:
+            if s1 is span:
+                continue
+            for s2 in by_bounds.get((s1.end_char, span.end_char), ()):
+                if s2 is not span and s2 is not s1:
+                    if (s1.text + s2.text).replace(" ", "") == span.text.replace(" ", ""):
+                        log_event(log, "concat", text=span.text, parts=[s1.text, s2.text])
+                        to_remove.add(span)
     candidates = [span for span in candidates if span not in to_remove]
 
-    # Suppression des chevauchements : si conflit, on garde le span le plus long
+    # Suppression des chevauchements (balayage par début) : si conflit, on garde le span le plus long
     spans = sorted(candidates, key=lambda s: s.start_char)
     keep = [True] * len(spans)
     for i in range(len(spans)):
         if not keep[i]:
             continue
         for j in range(i + 1, len(spans)):
+            # spans triés : plus aucun chevauchement possible avec i
+            if spans[j].start_char >= spans[i].end_char:
+                break
             if not keep[j]:
                 continue
-            if spans[i].start_char < spans[j].end_char and spans[j].start_char < spans[i].end_char:
-                len_i = spans[i].end_char - spans[i].start_char
-                len_j = spans[j].end_char - spans[j].start_char
-                if len_i >= len_j:
-                    print(f"Overlap detecté: '{spans[i].text}' (len={len_i}) recouvre '{spans[j].text}' (len={len_j}), plus long span gardé.")
-                    keep[j] = False
-                else:
-                    print(f"Overlap detecté: '{spans[j].text}' (len={len_j}) recouvre '{spans[i].text}' (len={len_i}), plus long span gardé.")
-                    keep[i] = False
-                    break
+            len_i = spans[i].end_char - spans[i].start_char
+            len_j = spans[j].end_char - spans[j].start_char
+            if len_i >= len_j:
+                log_event(log, "overlap", kept=spans[i].text, removed=spans[j].text)
+                keep[j] = False
+            else:
+                log_event(log, "overlap", kept=spans[j].text, removed=spans[i].text)
+                keep[i] = False
+                break
     final = [spans[i] for i in range(len(spans)) if keep[i]]
     return final
 
 
+def load_nlp(tokenizer_only: bool = False):
+    """
+    Charge le pipeline utilisé pour découper les paragraphes.
+    En mode tokenizer seul, pipeline allemand vide (mêmes règles de tokenisation que de_dep_news_trf)
+    avec un sentencizer pour conserver des limites de phrases dans les DocBin.
+    """
+    if tokenizer_only:
+        nlp = spacy.blank("de")
+        nlp.add_pipe("sentencizer")
+    else:
+        nlp = spacy.load("de_dep_news_trf")
+    customize_tokenizer(nlp)
+    return nlp
+
+
 def customize_tokenizer(nlp):
     """
     tokenizer personnel pour découper les tokens entre une lettre minuscule et une majuscule pour les spans collés
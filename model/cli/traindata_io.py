@@ -0,0 +1,75 @@
+"""
+Lecture et écriture en continu des données d'entraînement NER : [texte, [[start, end, label, uri], ...]].
+
+Format JSONL : une entrée par ligne, compressée en gzip si le nom du fichier se termine par .gz.
+Les anciens fichiers .json (liste complète) restent lisibles par iter_train_data.
+"""
+import gzip
+import json
+from pathlib import Path
+from typing import IO, Iterable, Iterator, List, Union
+
+
+def open_text(path: Union[str, Path], mode: str) -> IO[str]:
+    """
+    Ouvre un fichier texte UTF-8, compressé en gzip si son nom se termine par .gz
+    """
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class TrainDataWriter:
+    """
+    Écrit les entrées une par ligne ; le fichier est vidé sur disque toutes les `flush_every` entrées
+    et à la fermeture. Entre deux vidages, un lecteur (iter_train_data) ignore la dernière ligne incomplète.
+    """
+
+    def __init__(self, path: Union[str, Path], flush_every: int = 1000):
+        self.path = Path(path)
+        self.file = open_text(self.path, "w")
+        self.flush_every = flush_every
+        self.count = 0
+
+    def write(self, text: str, annotations: list):
+        self.file.write(json.dumps([text, annotations], ensure_ascii=False) + "\n")
+        self.count += 1
+        if self.flush_every and self.count % self.flush_every == 0:
+            self.file.flush()
+
+    def write_all(self, entries: Iterable[list]):
+        for text, annotations in entries:
+            self.write(text, annotations)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def iter_train_data(path: Union[str, Path]) -> Iterator[List]:
+    """
+    Parcourt les entrées une à une, sans charger le fichier en mémoire.
+    Une dernière ligne incomplète (fichier encore en cours d'écriture) est ignorée.
+    """
+    path = Path(path)
+    if path.suffix == ".json":
+        # ancien format : liste JSON complète
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
+        return
+    with open_text(path, "r") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except EOFError:
+            # flux gzip tronqué : le writer n'a pas encore terminé
+            return
@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import shutil
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Sequence
+
+import numpy as np
+from spacy.kb import InMemoryLookupKB
+
+from alias_index import AliasIndex
+from ann_index import build_kb_index
+from build_kb import (ContextReservoir, encode_entities, extract_mentions, fill_kb, file_digest, kb_state, load_vocab,
+                      pad_vec, stats_summary)
+from encoders import DEFAULT_ONNX_DIR, get_encoder
+from vector_store import convert_kb_dir
+
+"""
+Mise à jour incrémentale d'une KB construite par build_kb.py : seuls les nouveaux fichiers .spacy sont lus,
+seules les entités qu'ils mentionnent sont encodées.
+
+Les fréquences et comptes d'alias sont additionnés (priors recalculés), le vecteur d'une entité déjà connue
+devient la moyenne de l'ancien et du nouveau pondérée par leurs nombres de mentions.
+L'encodeur, la fenêtre de contexte, le mode de pooling et l'échantillonnage sont ceux de meta.json.
+Le dossier mis à jour est écrit à côté puis substitué à l'ancien ; les index dérivés des vecteurs
+(dodis_kb_mmap, ann_index) y sont reconstruits s'ils existaient, alias_index toujours.
+Une substitution interrompue est réparée au lancement suivant (recover_dir).
+
+Usage:
+python cli/update_kb.py --kb ./kb_exported --spacy ./nouveaux_docs.spacy
+"""
+
+
+def merge_vectors(old: np.ndarray, old_weight: int, new: np.ndarray, new_weight: int) -> np.ndarray:
+    if not old_weight:
+        return new
+    if not new_weight:
+        return old
+    return ((old * old_weight + new * new_weight) / (old_weight + new_weight)).astype(np.float32)
+
+
+# artefacts calculés à partir de dodis_kb : jamais copiés tels quels dans la KB mise à jour
+DERIVED = ("dodis_kb", "dodis_kb_mmap", "ann_index", "alias_index")
+
+
+def recover_dir(kb_dir: Path, logger: logging.Logger):
+    """
+    Termine une substitution interrompue : sans kb_dir, <kb>.old est la dernière KB complète et reprend sa place ;
+    avec kb_dir, <kb>.old n'est qu'un reste de substitution réussie
+    """
+    old_dir = kb_dir.with_name(kb_dir.name + ".old")
+    if not old_dir.exists():
+        return
+    if kb_dir.exists():
+        shutil.rmtree(old_dir)
+    else:
+        logger.warning(f"Mise à jour interrompue : {old_dir} restauré en {kb_dir}")
+        os.replace(old_dir, kb_dir)
+
+
+def replace_dir(tmp_dir: Path, kb_dir: Path):
+    """
+    Remplace kb_dir par tmp_dir. Entre les deux renommages, seul <kb>.old existe : recover_dir le restaure,
+    il n'est supprimé qu'une fois le nouveau dossier en place
+    """
+    old_dir = kb_dir.with_name(kb_dir.name + ".old")
+    if old_dir.exists() and kb_dir.exists():
+        shutil.rmtree(old_dir)
+    if kb_dir.exists():
+        os.replace(kb_dir, old_dir)
+    os.replace(tmp_dir, kb_dir)
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+
+
+def update_kb(
+    kb_dir: Path,
+    spacy_paths: Sequence[Path],
+    desc_file: str = "descriptions.json",
+    batch_size: int = 32,
+    log_level: str = "INFO",
+    vocab_only: bool = None,
+    onnx_dir: Path = DEFAULT_ONNX_DIR,
+    cache_dir: Path = None,
+    cache_max_entries: int = 0,
+    embed_workers: int = 1,
+    torch_threads: int = 0
+):
+    logging.basicConfig(level=getattr(logging, log_level.upper(), logging.INFO))
+    logger = logging.getLogger("spacy_kb_updater")
+
+    kb_dir = Path(kb_dir)
+    recover_dir(kb_dir, logger)
+    meta = json.loads((kb_dir / "meta.json").read_text("utf-8"))
+    state_path = kb_dir / "kb_state.json"
+    if not state_path.exists():
+        raise FileNotFoundError(f"{state_path} absent : KB antérieure à la mise à jour incrémentale, "
+                                f"la reconstruire avec build_kb.py")
+    state = json.loads(state_path.read_text("utf-8"))
+
+    # --- fichiers nouveaux seulement ---
+    known_paths = set(state["files"].values())
+    new_files: Dict[str, str] = {}
+    for path in spacy_paths:
+        path = Path(path)
+        digest = file_digest(path)
+        if digest in state["files"] or digest in new_files:
+            logger.info(f"  déjà intégré : {path}")
+        elif str(path.resolve()) in known_paths:
+            logger.warning(f"  {path} a changé depuis son intégration : ignoré (reconstruire la KB pour le réviser)")
+        else:
+            new_files[digest] = str(path.resolve())
+    if not new_files:
+        logger.info("Aucun nouveau fichier : KB inchangée")
+        return
+
+    if vocab_only is None:
+        vocab_only = meta.get("vocab_only", False)
+    vocab = load_vocab(meta["model"], vocab_only)
+    reservoir = ContextReservoir(meta.get("max_contexts", 0), meta.get("seed", 0))
+    new_paths = [Path(p) for p in new_files.values()]
+    freq, alias2ent2f, desc, n_mentions = extract_mentions(
+        new_paths, vocab, reservoir, logger, meta.get("context_sents", 0), meta.get("context_tokens", 0),
+        meta.get("pooling", "context"), meta.get("pool_window", 0))
+
+    # --- encodage des seules entités mentionnées ---
+    encoder_options = {"onnx_dir": onnx_dir}
+    encoder = get_encoder(meta.get("encoder", "bert-base-german-cased"), meta.get("encoder_backend", "hf"),
+                          threads=torch_threads, **encoder_options)
+    vec_len = meta["vec"]
+    logger.info(f"Étape 2/4 : encodage de {len(reservoir.samples)} entités touchées ({encoder.id})...")
+    touched, means, counts = encode_entities(reservoir, encoder, batch_size, logger, cache_dir, cache_max_entries,
+                                             new_paths, workers=embed_workers, threads=torch_threads,
+                                             encoder_options=encoder_options)
+    del reservoir
+
+    # --- fusion avec la KB existante ---
+    kb_old = InMemoryLookupKB(vocab=vocab, entity_vector_length=vec_len)
+    kb_old.from_disk(kb_dir / "dodis_kb")
+    entities = state["entities"]
+    new_vectors = {}
+    for eid, vec, count in zip(touched, means, counts):
+        old_mentions, old_count = entities.get(eid, [0, 0])
+        old_vec = np.asarray(kb_old.get_vector(eid), dtype=np.float32) if eid in entities else vec
+        new_vectors[eid] = merge_vectors(old_vec, old_mentions if old_count else 0,
+                                         pad_vec(vec, vec_len), freq[eid] if count else 0)
+        entities[eid] = [old_mentions + freq[eid], old_count + int(count)]
+
+    entity_ids = list(entities)
+    freqs = [float(entities[eid][0]) for eid in entity_ids]
+    vectors = [new_vectors[eid] if eid in new_vectors else np.asarray(kb_old.get_vector(eid), dtype=np.float32)
+               for eid in entity_ids]
+    del kb_old
+
+    aliases = defaultdict(lambda: defaultdict(int))
+    for alias, cand in state["aliases"].items():
+        aliases[alias].update(cand)
+    for alias, cand in alias2ent2f.items():
+        for eid, c in cand.items():
+            aliases[alias][eid] += c
+
+    kb = InMemoryLookupKB(vocab=vocab, entity_vector_length=vec_len)
+    fill_kb(kb, entity_ids, freqs, vectors, aliases, logger)
+
+    # --- écriture dans un dossier voisin puis substitution ---
+    tmp_dir = kb_dir.with_name(kb_dir.name + ".tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    shutil.copytree(kb_dir, tmp_dir, ignore=shutil.ignore_patterns(*DERIVED))
+    kb.to_disk(tmp_dir / "dodis_kb")
+
+    total_mentions = state["n_mentions"] + n_mentions
+    all_freq = Counter({eid: v[0] for eid, v in entities.items()})
+    (tmp_dir / "stats.json").write_text(
+        json.dumps(stats_summary(total_mentions, all_freq, aliases), indent=2, ensure_ascii=False), "utf-8")
+    with open(tmp_dir / "alias_sample.json", "w", encoding="utf-8") as f:
+        json.dump({k: dict(v) for k, v in list(aliases.items())[:20]}, f, indent=2, ensure_ascii=False)
+    desc_path = tmp_dir / desc_file
+    descriptions = json.loads(desc_path.read_text("utf-8")) if desc_path.exists() else {}
+    for eid, mention in desc.items():
+        descriptions.setdefault(eid, mention)
+    desc_path.write_text(json.dumps(descriptions, indent=2, ensure_ascii=False), "utf-8")
+    state = kb_state({**state["files"], **new_files}, total_mentions, all_freq, entity_ids,
+                     [entities[eid][1] for eid in entity_ids], aliases)
+    (tmp_dir / "kb_state.json").write_text(json.dumps(state, ensure_ascii=False), "utf-8")
+    alias_index = AliasIndex.from_counts(state["aliases"], {eid: v[0] for eid, v in entities.items()})
+    alias_index.to_disk(tmp_dir / "alias_index")
+    if (kb_dir / "dodis_kb_mmap").exists():
+        mmap_cfg = json.loads((kb_dir / "dodis_kb_mmap" / "cfg.json").read_text("utf-8"))
+        convert_kb_dir(tmp_dir, tmp_dir / "dodis_kb_mmap", mmap_cfg["dtype"])
+    if (kb_dir / "ann_index").exists():
+        ann_cfg = json.loads((kb_dir / "ann_index" / "cfg.json").read_text("utf-8"))
+        build_kb_index(tmp_dir, ann_cfg.get("requested_lists", 0), ann_cfg.get("n_iter", 20), ann_cfg.get("seed", 0))
+        logger.info("ann_index reconstruit")
+    replace_dir(tmp_dir, kb_dir)
+
+    print("=" * 60)
+    print(f"KB mise à jour : {len(new_files)} fichier(s), {n_mentions} mentions, {len(touched)} entités touchées")
+    print(f"  Entités dans KB : {len(entity_ids)}")
+    print(f"  Alias dans KB   : {len(aliases)}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Intègre de nouveaux fichiers .spacy (DocBin) à une KB existante")
+    parser.add_argument("--kb", required=True, help="Dossier de la KB (sortie de build_kb.py)")
+    parser.add_argument("--spacy", nargs="+", required=True, help="Fichiers .spacy ; ceux déjà intégrés sont ignorés")
+    parser.add_argument("--desc-file", default="descriptions.json")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--vocab-only", action="store_true", default=None,
+                        help="Vocabulaire seul (par défaut : comme à la construction)")
+    parser.add_argument("--onnx-dir", default=str(DEFAULT_ONNX_DIR))
+    parser.add_argument("--embedding-cache", default=None)
+    parser.add_argument("--cache-max-entries", type=int, default=2_000_000)
+    parser.add_argument("--embed-workers", type=int, default=1)
+    parser.add_argument("--torch-threads", type=int, default=0)
+    args = parser.parse_args()
+
+    update_kb(
+        kb_dir=Path(args.kb),
+        spacy_paths=[Path(p) for p in args.spacy],
+        desc_file=args.desc_file,
+        batch_size=args.batch_size,
+        log_level=args.log_level,
+        vocab_only=args.vocab_only,
+        onnx_dir=Path(args.onnx_dir),
+        cache_dir=Path(args.embedding_cache) if args.embedding_cache else None,
+        cache_max_entries=args.cache_max_entries,
+        embed_workers=args.embed_workers,
+        torch_threads=args.torch_threads
+    )
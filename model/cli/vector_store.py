@@ -0,0 +1,313 @@
+"""
+KB spaCy dont les tableaux (vecteurs d'entités en float16 ou float32, fréquences, alias et priors) sont des fichiers .npy
+mappés en mémoire : le chargement est immédiat et les processus d'inférence d'une même machine partagent
+les pages via le cache du système au lieu d'en garder chacun une copie.
+
+Index : hachages spaCy des entités et des alias, triés (recherche par bisection), ligne = position dans le tri.
+    <dossier>/cfg.json             dimension, type des vecteurs, tailles
+    <dossier>/strings.json         chaînes des entités et des alias (ajoutées au vocabulaire au chargement)
+    <dossier>/entity_hashes.npy    uint64 [n_entités], triés
+    <dossier>/entity_freqs.npy     float32 [n_entités]
+    <dossier>/vectors.npy          float16|float32 [n_entités, dim]
+    <dossier>/alias_hashes.npy     uint64 [n_alias], triés
+    <dossier>/alias_offsets.npy    int64 [n_alias + 1] (candidats de l'alias i : offsets[i]:offsets[i+1])
+    <dossier>/alias_rows.npy       int32, lignes des entités candidates
+    <dossier>/alias_priors.npy     float32
+
+Conversion d'une KB de build_kb.py (fréquences des entités lues dans kb_state.json) :
+python cli/vector_store.py --kb ./kb_exported --dtype float16          (→ ./kb_exported/dodis_kb_mmap)
+Conversion du composant entity_linker d'un pipeline entraîné (config mis à jour) :
+python cli/vector_store.py --pipeline ./trained_model/model-best-nel --output ./trained_model/model-best-nel-mmap \
+    --state ./kb_exported/kb_state.json
+Après l'écriture, la KB convertie est relue et la fréquence de chaque entité vérifiée.
+Le pipeline converti se charge après `import vector_store` (ou avec --code cli/vector_store.py pour spacy).
+"""
+import io
+import json
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import spacy
+import srsly
+from spacy.kb import Candidate, InMemoryLookupKB, KnowledgeBase
+from spacy.tokens import Span
+from spacy.vocab import Vocab
+
+ARRAYS = ("entity_hashes", "entity_freqs", "vectors", "alias_hashes", "alias_offsets", "alias_rows", "alias_priors")
+
+
+def _lookup(sorted_hashes: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """
+    Positions des clés dans le tableau trié, -1 pour les clés absentes
+    """
+    if not len(sorted_hashes):
+        return np.full(len(keys), -1, dtype=np.int64)
+    pos = np.searchsorted(sorted_hashes, keys)
+    pos = np.minimum(pos, len(sorted_hashes) - 1)
+    return np.where(sorted_hashes[pos] == keys, pos, -1)
+
+
+class MmapLookupKB(KnowledgeBase):
+    """
+    KnowledgeBase en lecture seule sur des tableaux mappés en mémoire (voir l'en-tête du module)
+    """
+
+    def __init__(self, vocab: Vocab, entity_vector_length: int):
+        super().__init__(vocab, entity_vector_length)
+        self.dtype = np.float32
+        self.strings: List[str] = []
+        self.arrays = {
+            "entity_hashes": np.zeros(0, dtype=np.uint64),
+            "entity_freqs": np.zeros(0, dtype=np.float32),
+            "vectors": np.zeros((0, entity_vector_length), dtype=np.float32),
+            "alias_hashes": np.zeros(0, dtype=np.uint64),
+            "alias_offsets": np.zeros(1, dtype=np.int64),
+            "alias_rows": np.zeros(0, dtype=np.int32),
+            "alias_priors": np.zeros(0, dtype=np.float32),
+        }
+
+    # --- construction ---
+
+    @classmethod
+    def from_kb(cls, kb: InMemoryLookupKB, dtype: str = "float16",
+                freqs: Optional[Dict[str, float]] = None) -> "MmapLookupKB":
+        """
+        Copie une InMemoryLookupKB. InMemoryLookupKB n'expose les fréquences que sur les candidats des alias :
+        sans `freqs` (entité -> fréquence, voir state_freqs), une entité sans alias reçoit 0
+        """
+        strings = kb.vocab.strings
+        entities = sorted(kb.get_entity_strings(), key=lambda e: strings[e])
+        aliases = sorted(kb.get_alias_strings(), key=lambda a: strings[a])
+        row_of = {e: i for i, e in enumerate(entities)}
+        freq_of = np.zeros(len(entities), dtype=np.float32)
+        offsets, rows, priors = [0], [], []
+        for alias in aliases:
+            for cand in kb.get_alias_candidates(alias):
+                rows.append(row_of[cand.entity_])
+                priors.append(cand.prior_prob)
+                freq_of[row_of[cand.entity_]] = cand.entity_freq
+            offsets.append(len(rows))
+        if freqs is not None:
+            missing = [e for e in entities if e not in freqs]
+            if missing:
+                raise ValueError(f"{len(missing)} entités de la KB sans fréquence, par ex. {missing[:5]}")
+            freq_of = np.array([freqs[e] for e in entities], dtype=np.float32)
+
+        new = cls(kb.vocab, kb.entity_vector_length)
+        new.dtype = np.dtype(dtype)
+        new.strings = entities + aliases
+        new.arrays = {
+            "entity_hashes": np.array([strings[e] for e in entities], dtype=np.uint64),
+            "entity_freqs": freq_of,
+            "vectors": np.array([kb.get_vector(e) for e in entities], dtype=dtype).reshape(-1, kb.entity_vector_length),
+            "alias_hashes": np.array([strings[a] for a in aliases], dtype=np.uint64),
+            "alias_offsets": np.array(offsets, dtype=np.int64),
+            "alias_rows": np.array(rows, dtype=np.int32),
+            "alias_priors": np.array(priors, dtype=np.float32),
+        }
+        return new
+
+    # --- consultation ---
+
+    def __len__(self) -> int:
+        return self.get_size_entities()
+
+    def is_empty(self) -> bool:
+        return len(self) == 0
+
+    def get_size_entities(self) -> int:
+        return len(self.arrays["entity_hashes"])
+
+    def get_size_aliases(self) -> int:
+        return len(self.arrays["alias_hashes"])
+
+    def get_entity_strings(self) -> List[str]:
+        return [self.vocab.strings[int(h)] for h in self.arrays["entity_hashes"]]
+
+    def get_alias_strings(self) -> List[str]:
+        return [self.vocab.strings[int(h)] for h in self.arrays["alias_hashes"]]
+
+    def entity_rows(self, entities: Iterable[str]) -> np.ndarray:
+        keys = np.array([self.vocab.strings[e] for e in entities], dtype=np.uint64)
+        return _lookup(self.arrays["entity_hashes"], keys)
+
+    def contains_entity(self, entity: str) -> bool:
+        return bool(self.entity_rows([entity])[0] >= 0)
+
+    def contains_alias(self, alias: str) -> bool:
+        return self.alias_row(alias) >= 0
+
+    def alias_row(self, alias: str) -> int:
+        key = np.array([self.vocab.strings[alias]], dtype=np.uint64)
+        return int(_lookup(self.arrays["alias_hashes"], key)[0])
+
+    def get_vector(self, entity: str) -> np.ndarray:
+        return self.get_vectors([entity])[0]
+
+    def get_vectors(self, entities: Iterable[str]) -> np.ndarray:
+        """
+        Vecteurs en float32 ; vecteur nul pour une entité inconnue (comme InMemoryLookupKB)
+        """
+        rows = self.entity_rows(entities)
+        out = np.zeros((len(rows), self.entity_vector_length), dtype=np.float32)
+        found = rows >= 0
+        out[found] = self.arrays["vectors"][rows[found]]
+        return out
+
+    def get_alias_candidates(self, alias: str) -> List[Candidate]:
+        i = self.alias_row(alias)
+        if i < 0:
+            return []
+        start, end = self.arrays["alias_offsets"][i : i + 2]
+        rows = self.arrays["alias_rows"][start:end]
+        vectors = self.arrays["vectors"][rows].astype(np.float32)
+        alias_hash = self.vocab.strings[alias]
+        return [
+            Candidate(kb=self, entity_hash=int(self.arrays["entity_hashes"][row]),
+                      entity_freq=float(self.arrays["entity_freqs"][row]), entity_vector=vector,
+                      alias_hash=alias_hash, prior_prob=float(prior))
+            for row, vector, prior in zip(rows, vectors, self.arrays["alias_priors"][start:end])
+        ]
+
+    def get_candidates(self, mention: Span) -> List[Candidate]:
+        return self.get_alias_candidates(mention.text)
+
+    # --- sérialisation ---
+
+    def cfg(self) -> dict:
+        return {"dim": self.entity_vector_length, "dtype": np.dtype(self.dtype).name,
+                "n_entities": self.get_size_entities(), "n_aliases": self.get_size_aliases()}
+
+    def add_strings(self):
+        for s in self.strings:
+            self.vocab.strings.add(s)
+
+    def to_disk(self, path: Union[str, Path], exclude: Iterable[str] = tuple()):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ARRAYS:
+            np.save(path / f"{name}.npy", np.ascontiguousarray(self.arrays[name]))
+        srsly.write_json(path / "strings.json", self.strings)
+        srsly.write_json(path / "cfg.json", self.cfg())
+
+    def from_disk(self, path: Union[str, Path], exclude: Iterable[str] = tuple()):
+        path = Path(path)
+        cfg = srsly.read_json(path / "cfg.json")
+        if cfg["dim"] != self.entity_vector_length:
+            raise ValueError(f"Dimension des vecteurs : {cfg['dim']} sur disque, {self.entity_vector_length} attendue")
+        self.dtype = np.dtype(cfg["dtype"])
+        self.arrays = {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        self.strings = srsly.read_json(path / "strings.json")
+        self.add_strings()
+        return self
+
+    def to_bytes(self, **kwargs) -> bytes:
+        data = {"cfg": self.cfg(), "strings": self.strings}
+        for name in ARRAYS:
+            buffer = io.BytesIO()
+            np.save(buffer, np.ascontiguousarray(self.arrays[name]))
+            data[name] = buffer.getvalue()
+        return srsly.msgpack_dumps(data)
+
+    def from_bytes(self, bytes_data: bytes, *, exclude: Tuple[str] = tuple()):
+        # chargement en mémoire (pas de partage de pages) : préférer from_disk
+        data = srsly.msgpack_loads(bytes_data)
+        self.dtype = np.dtype(data["cfg"]["dtype"])
+        self.arrays = {name: np.load(io.BytesIO(data[name])) for name in ARRAYS}
+        self.strings = data["strings"]
+        self.add_strings()
+        return self
+
+
+@spacy.registry.misc("dodis.EmptyMmapKB.v1")
+def empty_mmap_kb() -> Callable[[Vocab, int], KnowledgeBase]:
+    def empty_kb_factory(vocab: Vocab, entity_vector_length: int):
+        return MmapLookupKB(vocab=vocab, entity_vector_length=entity_vector_length)
+
+    return empty_kb_factory
+
+
+@spacy.registry.misc("dodis.MmapKBFromFile.v1")
+def load_mmap_kb(kb_path: Path) -> Callable[[Vocab], KnowledgeBase]:
+    def kb_from_file(vocab: Vocab):
+        cfg = srsly.read_json(Path(kb_path) / "cfg.json")
+        return MmapLookupKB(vocab=vocab, entity_vector_length=cfg["dim"]).from_disk(kb_path)
+
+    return kb_from_file
+
+
+def state_freqs(state_path: Path) -> Dict[str, float]:
+    """
+    Fréquences des entités (nombre de mentions) de kb_state.json, celles données à la KB par build_kb.py / update_kb.py
+    """
+    state = json.loads(Path(state_path).read_text("utf-8"))
+    return {eid: float(mentions) for eid, (mentions, _) in state["entities"].items()}
+
+
+def check_freqs(path: Path, vocab: Vocab, freqs: Dict[str, float]):
+    """
+    Relit la KB convertie et vérifie la fréquence de chaque entité
+    """
+    cfg = srsly.read_json(Path(path) / "cfg.json")
+    kb = MmapLookupKB(vocab, cfg["dim"]).from_disk(path)
+    stored = dict(zip(kb.get_entity_strings(), kb.arrays["entity_freqs"].tolist()))
+    wrong = [e for e, freq in freqs.items() if stored.get(e) != np.float32(freq)]
+    if wrong or len(stored) != len(freqs):
+        raise ValueError(f"{path} : {len(wrong)} fréquences d'entités incorrectes "
+                         f"({len(stored)} entités pour {len(freqs)} attendues), par ex. {wrong[:5]}")
+
+
+def convert_kb_dir(kb_dir: Path, output: Path, dtype: str):
+    """
+    dodis_kb (InMemoryLookupKB, dimension lue dans meta.json) → dossier MmapLookupKB,
+    avec les fréquences de kb_state.json
+    """
+    meta = json.loads((kb_dir / "meta.json").read_text("utf-8"))
+    vocab = spacy.blank("de").vocab
+    kb = InMemoryLookupKB(vocab=vocab, entity_vector_length=meta["vec"])
+    kb.from_disk(kb_dir / "dodis_kb")
+    freqs = state_freqs(kb_dir / "kb_state.json") if (kb_dir / "kb_state.json").exists() else None
+    MmapLookupKB.from_kb(kb, dtype, freqs).to_disk(output)
+    if freqs is not None:
+        check_freqs(output, vocab, freqs)
+    print(f"KB mappée écrite dans {output} ({kb.get_size_entities()} entités, {kb.get_size_aliases()} alias, {dtype})")
+
+
+def convert_pipeline(pipeline: Path, output: Path, dtype: str, component: str = "entity_linker",
+                     freqs: Optional[Dict[str, float]] = None):
+    """
+    Remplace la KB du composant entity_linker par une MmapLookupKB et enregistre le pipeline sous `output`
+    (fréquences : voir MmapLookupKB.from_kb)
+    """
+    nlp = spacy.load(pipeline)
+    linker = nlp.get_pipe(component)
+    linker.kb = MmapLookupKB.from_kb(linker.kb, dtype, freqs)
+    nlp.to_disk(output)
+    if freqs is not None:
+        check_freqs(output / component / "kb", nlp.vocab, freqs)
+    config = spacy.util.load_config(output / "config.cfg")
+    config["components"][component]["generate_empty_kb"] = {"@misc": "dodis.EmptyMmapKB.v1"}
+    config.to_disk(output / "config.cfg")
+    print(f"Pipeline écrit dans {output} (KB mappée, {dtype})")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convertit une KB spaCy en KB mappée en mémoire")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--kb", help="Dossier de sortie de build_kb.py (meta.json + dodis_kb)")
+    source.add_argument("--pipeline", help="Pipeline entraîné contenant un entity_linker")
+    parser.add_argument("--output", default=None, help="Par défaut : <kb>/dodis_kb_mmap ou <pipeline>-mmap")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+    parser.add_argument("--state", default=None,
+                        help="kb_state.json de la KB du pipeline (fréquences des entités, avec --pipeline)")
+    args = parser.parse_args()
+
+    if args.kb:
+        kb_dir = Path(args.kb)
+        convert_kb_dir(kb_dir, Path(args.output) if args.output else kb_dir / "dodis_kb_mmap", args.dtype)
+    else:
+        pipeline = Path(args.pipeline)
+        output = Path(args.output) if args.output else pipeline.with_name(pipeline.name + "-mmap")
+        convert_pipeline(pipeline, output, args.dtype, freqs=state_freqs(Path(args.state)) if args.state else None)